@@ -2,15 +2,21 @@ from base_logger import logger
 from tools import get_absolute_path, get_parent_folder
 from tools import handle_logs, clean_node_metadata, remove_special_chars_in_llm_output, get_local_name
 from tools import cleanWords
+from token_counter import chunk_length_function
 from memgraph_interface import initialize_graph_with_chunk, create_fileNode, linkActiveNodesToFile
 from memgraph_interface import merge_new_graph_chunk_node, create_fileNode
-from lmstudio import get_embedding
-from interactions import create_knowledge_graph_with_llm
+from lmstudio import get_embeddings, embedding_model_name
+from interactions import create_knowledge_graph_with_llm, extract_knowledge_graph_with_llm
 from rdf_interface import search_rdf_classes_objects, get_class_hierarchy
-from postgresql import insert_chunks_with_vectors, initialize_vector_table, select_prompt
+from postgresql import VectorBulkLoader, initialize_vector_table, create_vector_index, ensure_vector_index, select_prompt
+from postgresql import vector_file_states, register_vector_file, remove_vector_files
 
 import os
 import math
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader
 from tqdm import tqdm
@@ -42,7 +48,7 @@ def graph_from_pdf_directory(config, postgresql_connection, graph, use_ontology=
 		text_splitter = RecursiveCharacterTextSplitter(
 		chunk_size = config.chunk_size,
 		chunk_overlap  = config.chunk_overlap,
-		length_function = len,
+		length_function = chunk_length_function(config),
 		is_separator_regex = False,
 		)
 	except Exception as ex:
@@ -57,7 +63,7 @@ def graph_from_pdf_directory(config, postgresql_connection, graph, use_ontology=
 		text_splitter_kg = RecursiveCharacterTextSplitter(
 		chunk_size = config.chunk_size_graph,
 		chunk_overlap  = config.chunk_overlap_graph,
-		length_function = len,
+		length_function = chunk_length_function(config),
 		is_separator_regex = False,
 		)
 	except Exception as ex:
@@ -73,20 +79,35 @@ def graph_from_pdf_directory(config, postgresql_connection, graph, use_ontology=
 	if "000000" not in errnum:
 		return errnum, errmsg
 
-	initialize_graph_with_chunk(graph)
-
+	incremental=getattr(config, 'vector_build_mode', 'rebuild') == 'incremental'
+	file_states=vector_file_states(postgresql_connection)
+	if file_states is None:
+		return handle_logs(107,"Files already loaded in vector table couldn't be retrieved",logger.CRITICAL)
+	pdf_files=[file for file in os.listdir(full_path) if file.endswith('.pdf')]
+	errnum, errmsg=remove_vector_files(postgresql_connection, set(file_states) - {os.path.join(full_path, file) for file in pdf_files})
+	if "000000" not in errnum:
+		return errnum, errmsg
+	vector_loader=VectorBulkLoader(postgresql_connection, config, upsert=bool(file_states))
+	# Files loaded by this run can be searched on their own through their batch
+	batch=getattr(config, 'vector_ingestion_batch', None) or time.strftime('%Y%m%d-%H%M%S')
+	logger.info(f"Ingestion batch: {batch}")
 
 	results=search_rdf_classes_objects(rdf_graph)
 	node_labels, rel_types, relationship_type, additional_instructions=create_variables_for_up_with_rdf(results)
 	system_prompt, human_prompt_string=create_unstructured_prompt(node_labels, rel_types, relationship_type, additional_instructions, postgresql_connection, config)
 	logger.debug(f"------\nsystem_prompt:\n{system_prompt}\n-----\n human_prompt_string\n{human_prompt_string}")
 	rdf_nodes, rdf_edges, local2uri=get_rdf_nodes_edges(results)
+	initialize_graph_with_chunk(graph, rdf_nodes)
 	hierarchy=get_class_hierarchy(rdf_graph)
 	rel_hierarchy=get_class_hierarchy(rdf_graph,'property')
 
 	vector_node_count=0
-	file_counter=0
-	for file in tqdm(os.listdir(full_path)):
+	# File IDs already assigned are kept, so chunk IDs of unchanged files stay the same
+	file_counter=max([int(file_id, 16)+1 for file_id, _ in file_states.values()], default=0)
+	skipped_files=0
+	kg_chunks=0
+	kg_seconds=0.0
+	for file in tqdm(pdf_files):
 		if file.endswith('.pdf'):
 			pdf_path = os.path.join(full_path, file)
 			logger.info(f"Processing file: {pdf_path}")
@@ -95,61 +116,161 @@ def graph_from_pdf_directory(config, postgresql_connection, graph, use_ontology=
 			for doc in loader.load():
 				full_pdf_text += doc.page_content +"\n" # grab the text of the item
 			# Vector Side
-			item_text_chunks = text_splitter.split_text(full_pdf_text) # split the text into chunks
-			logger.debug(f'item_text_chunks size for vectors: {len(item_text_chunks)}')
-			chunk_seq_id = 0
-			file_seq_id= f"{file_counter:06x}"
-			for chunk in item_text_chunks: 
-				chunk_with_metadata=create_chunk_with_metadata_and_vector(config, pdf_path, chunk, chunk_seq_id, file_seq_id)
-				errnum, errmsg=insert_chunks_with_vectors(postgresql_connection, chunk_with_metadata)
+			content_hash=file_content_hash(config, pdf_path)
+			if pdf_path in file_states:
+				file_seq_id=file_states[pdf_path][0]
+			else:
+				file_seq_id= f"{file_counter:06x}"
+				file_counter+=1
+			if incremental and file_states.get(pdf_path, (None, None))[1] == content_hash:
+				logger.info(f"Vectors of {file} are up to date")
+				skipped_files+=1
+			else:
+				item_text_chunks = text_splitter.split_text(full_pdf_text) # split the text into chunks
+				logger.debug(f'item_text_chunks size for vectors: {len(item_text_chunks)}')
+				chunk_ids=[]
+				for chunk_with_metadata in create_chunks_with_metadata_and_vectors(config, pdf_path, item_text_chunks, file_seq_id): 
+					errnum, errmsg=vector_loader.add(chunk_with_metadata)
+					if "000000" not in errnum:
+						return errnum, errmsg
+					chunk_ids.append(chunk_with_metadata['chunkId'])
+				errnum, errmsg=vector_loader.flush()
+				if "000000" not in errnum:
+					return errnum, errmsg
+				errnum, errmsg=register_vector_file(postgresql_connection, pdf_path, file_seq_id, content_hash, chunk_ids, batch)
 				if "000000" not in errnum:
 					return errnum, errmsg
-				chunk_seq_id += 1
 			# Graph Side
 			item_text_chunks = text_splitter.split_text(full_pdf_text) # split the text into chunks
 			chunk_seq_id = 0
 			logger.debug(f'item_text_chunks size for knowledge graph: {len(item_text_chunks)}')
-			for chunk in tqdm(item_text_chunks, leave=False, desc="Adding chunks to knowledge graph"): 
-				query=human_prompt_string+chunk
+			queries=[human_prompt_string+chunk for chunk in item_text_chunks]
+			kg_start=time.perf_counter()
+			# LLM extractions may run concurrently, but the KG is only written here, one chunk at a time and in order
+			for chunk, query, llm_response in tqdm(zip(item_text_chunks, queries, llm_extractions_in_order(config, system_prompt, queries)), total=len(queries), leave=False, desc="Adding chunks to knowledge graph"): 
 				chunk_with_metadata=create_chunk_with_metadata_no_vector(pdf_path, chunk, chunk_seq_id)
-				create_knowledge_graph_with_llm(postgresql_connection, config, graph, chunk_with_metadata, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy,system_prompt, query)
+				create_knowledge_graph_with_llm(postgresql_connection, config, graph, chunk_with_metadata, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy,system_prompt, query, llm_response)
 				"""
 				errnum, errmsg=create_knowledge_graph_with_llm(config, graph, chunk, rdf_graph)
 				if "000000" not in errnum:
 					return errnum, errmsg
 				"""
 				chunk_seq_id += 1
+			kg_elapsed=time.perf_counter()-kg_start
+			kg_chunks+=chunk_seq_id
+			kg_seconds+=kg_elapsed
+			if kg_elapsed > 0:
+				logger.info(f"Knowledge graph of {file}: {chunk_seq_id} chunks in {kg_elapsed:.1f}s ({chunk_seq_id/kg_elapsed:.2f} chunks/sec)")
 
 			create_fileNode(graph, pdf_path, file_seq_id)
 			linkActiveNodesToFile(graph,  file_seq_id)
-			file_counter+=1
 
+	if incremental:
+		logger.info(f"Vector table: {len(pdf_files)-skipped_files} file(s) loaded, {skipped_files} unchanged")
+		errnum, errmsg=ensure_vector_index(postgresql_connection, config)
+	else:
+		errnum, errmsg=create_vector_index(postgresql_connection, config)
+	if "000000" not in errnum:
+		return errnum, errmsg
+
+	if kg_seconds > 0:
+		logger.info(f"Knowledge graph extraction: {kg_chunks} chunks in {kg_seconds:.1f}s ({kg_chunks/kg_seconds:.2f} chunks/sec) using {getattr(config, 'kg_extraction_workers', 1)} worker(s)")
 	
 	return handle_logs()
 
 
-def create_chunk_with_metadata_and_vector(config, pdf_path, chunk, chunk_seq_id, file_seq_id):
+def file_content_hash(config, pdf_path):
+	"""
+	Hash that changes whenever a file must be loaded again in the vector table: when its content changes,
+	or when the settings used to split and embed it change
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		str (pdf_path): Filepath
+
+	Returns:
+		str: SHA-256 hex digest
+	"""
+	settings=[embedding_model_name(config), config.llm_embedding_vector_len, config.chunk_size, config.chunk_overlap, getattr(config, 'chunk_length_unit', 'characters')]
+	content_hash=hashlib.sha256(repr(settings).encode('utf-8'))
+	with open(pdf_path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			content_hash.update(block)
+	return content_hash.hexdigest()
+
+def llm_extractions_in_order(config, system_prompt, queries):
+	"""
+	Yields the LLM extraction of each query, in the same order as queries. When config.kg_extraction_workers is
+	greater than 1, up to config.kg_max_in_flight requests are sent to the LLM at the same time
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		string (system_prompt): Behavior to be adopted by LLM to create KG
+		list (queries): LLM requests to create KG, one per text chunk
+
+	Returns:
+		Generator of LLM responses
+	"""
+	workers=getattr(config, 'kg_extraction_workers', 1)
+	if workers <= 1:
+		for query in queries:
+			yield extract_knowledge_graph_with_llm(config, system_prompt, query)
+		return
+	max_in_flight=max(workers, getattr(config, 'kg_max_in_flight', workers))
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kg-extraction") as executor:
+		pending=deque()
+		for query in queries:
+			pending.append(executor.submit(extract_knowledge_graph_with_llm, config, system_prompt, query))
+			if len(pending) >= max_in_flight:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def create_chunks_with_metadata_and_vectors(config, pdf_path, chunks, file_seq_id):
 	"""
-	From a given text chunk, creates a dictionary containing the text itself, alongside its metadata including the vectorial representation (embedding)
+	From a list of text chunks of the same file, creates the dictionaries containing each text, alongside its metadata including the embedding.
+	Embeddings are requested in batches
 
 	Params:
 		dict (config): Configuration dictionary using values from .yaml file
+		str (pdf_path): Filepath 
+		list (chunks): Text chunks, ordered by their chunk ID
+		str (file_seq_id): File ID
+
+	Returns:
+		List of dictionaries containing text chunk with metadata (including embedding), in the same order as chunks
+	"""
+	vectors = get_embeddings(config, [cleanWords(chunk) for chunk in chunks])
+	chunks_with_metadata=[]
+	for chunk_seq_id, (chunk, vector) in enumerate(zip(chunks, vectors)):
+		chunk_with_metadata=chunk_metadata_with_vector(pdf_path, chunk, chunk_seq_id, file_seq_id, vector)
+		if vector is None:
+			logger.error(f"Chunk {chunk_with_metadata['chunkId']} couldn't be embedded")
+		chunks_with_metadata.append(chunk_with_metadata)
+	return chunks_with_metadata
+
+def chunk_metadata_with_vector(pdf_path, chunk, chunk_seq_id, file_seq_id, vector):
+	"""
+	Creates the dictionary of a text chunk whose embedding has already been computed
+
+	Params:
 		str (pdf_path): Filepath 
 		str (chunk): Text chunk
 		int (chunk_seq_id): Text chunk ID
 		str (file_seq_id): File ID
+		numpy.ndarray (vector): Text chunk embedding (float32)
 
 	Returns:
 		Dictionary containing text chunk with metadata (including embedding)
 	"""
 	form_id = pdf_path[pdf_path.rindex('/') + 1:pdf_path.rindex('.')] # extract form id from file name
-	text = cleanWords(chunk)
-	vector = get_embedding(config, text)
 	chunk_with_metadata={
 		'text': chunk, 
 		'filename': pdf_path,
 		# constructed metadata...
-		'embedding': f'{vector}',
+		'embedding': vector,
+		'fileId': file_seq_id,
 		'chunkId': f'file-{file_seq_id}_form-{form_id}_chunk-{chunk_seq_id:09d}',
 		}
 	return chunk_with_metadata
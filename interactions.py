@@ -1,16 +1,17 @@
 from base_logger import logger
 from tools import cleanWords, get_local_name
 from tools import handle_logs, clean_node_metadata, remove_special_chars_in_llm_output
-from lmstudio import get_embedding
-from lmstudio import get_chat_completion
-from memgraph_interface import insert_knowledge_graph_nodes_relations, return_graph_labels
+from lmstudio import get_embedding, get_embeddings
+from lmstudio import get_chat_completion, stream_chat_completion
+from token_counter import count_tokens, token_margin
+from memgraph_interface import KnowledgeGraphBatch, return_graph_labels
 from memgraph_interface import return_onProcess_nodes, remove_onProcess_status, combine_similar_group_nodes
 from memgraph_interface import create_new_relations, counts_connections_from_a_to_b, return_schema
 from rdf_interface import get_subclass_uri, validate_relation, provide_relation_comment
 import ast
 import json
 
-from postgresql import cosine_vector_search, select_prompt
+from postgresql import cosine_vector_search, batch_cosine_vector_search, hybrid_vector_search, select_prompt
 
 
 def clean_output_LLM_list(llm_output:str)->str:
@@ -50,7 +51,36 @@ def clean_output_LLM_list(llm_output:str)->str:
 
 
 
-def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy, system_prompt, query):
+def extract_knowledge_graph_with_llm(config, system_prompt, query):
+	"""
+	Asks the LLM for the set of relations found in a text chunk. It doesn't read or write the KG, so it can run concurrently for several chunks
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		string (system_prompt): Behavior to be adopted by LLM to create KG
+		string (query): LLM request to create KG
+
+	Returns:
+		string (jtext): LLM response
+	"""
+	messages = [
+		{"role": "system", "content": system_prompt},
+		{"role": "user", "content": query}
+	]
+	logger.info("Calling LLM for text analysys to create knowledge graph")
+	# logger.debug(f"System Prompt: {system_prompt}")
+	# logger.debug(f"Query: {query}")
+	ai_msg = get_chat_completion(config, messages, completion_tokens=getattr(config, 'llm_kg_answer_tokens', 2048))
+	jtext=ai_msg
+	if ai_msg is None:
+		# An empty answer is reported as an invalid format, and isn't asked again by create_knowledge_graph_with_llm
+		logger.error("Didn't get a knowledge graph answer from LM Studio")
+		jtext=""
+	elif config.llm_chat_model.startswith('deepseek'):
+		jtext=extract_json_from_deepseek(ai_msg)
+	return jtext
+
+def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy, system_prompt, query, llm_response=None):
 	"""
 	Creates KG in Memgraph using ontology definitions
 
@@ -67,21 +97,14 @@ def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk
 		dict (rel_hierarchy): Dictionary that lists, per ontology relation, the set of superclass related to that relation
 		string (system_prompt): Behavior to be adopted by LLM to create KG
 		string (query): LLM request to create KG
+		string (llm_response): Response already obtained with extract_knowledge_graph_with_llm. If None, the LLM is called
 
 	Returns:
 		Message Code, and Message Text.
 	"""
-	messages = [
-		{"role": "system", "content": system_prompt},
-		{"role": "user", "content": query}
-	]
-	logger.info("Calling LLM for text analysys to create knowledge graph")
-	# logger.debug(f"System Prompt: {system_prompt}")
-	# logger.debug(f"Query: {query}")
-	ai_msg = get_chat_completion(config, messages)    
-	jtext=ai_msg
-	if config.llm_chat_model.startswith('deepseek'):
-		jtext=extract_json_from_deepseek(ai_msg)
+	jtext=llm_response
+	if jtext is None:
+		jtext=extract_knowledge_graph_with_llm(config, system_prompt, query)
 	
 	logger.info(f"LLM response: {jtext}")
 	searching_keys=['text', 'head', 'head_type', 'relation', 'tail', 'tail_type']
@@ -95,6 +118,7 @@ def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk
 			logger.debug(f"Analyzed text: {jtext}")
 
 		if isinstance(connections, list):
+			batch=KnowledgeGraphBatch(graph, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy)
 			for conn in connections:
 				try:
 					if not isinstance(conn, dict):
@@ -107,11 +131,14 @@ def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk
 						raise KeyError("Model didn't generate required tags."+str(conn.keys()))
 
 					conn['prefix_id']=f"{counter_prefix_id:03d}"
-					insert_knowledge_graph_nodes_relations(graph, conn, chunk, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy)
+					batch.add(conn)
 					counter_prefix_id+=1
 
 				except (ValueError, KeyError) as e:
+					# Triples before the invalid one are kept, as when they were written one by one
+					batch.flush()
 					return handle_logs(errnum=401, errmsg=f"Error: Invalid input format. {e}", logging_level=logger.CRITICAL)
+			batch.flush()
 			if rdf_graph is not None:
 				attempt_merging(postgresql_connection, config, graph, rdf_graph, local2uri, hierarchy, chunk)
 				attmpt_force_new_relations(postgresql_connection, config, graph, rdf_graph, rdf_edges, local2uri, chunk)
@@ -122,7 +149,7 @@ def create_knowledge_graph_with_llm(postgresql_connection, config, graph,  chunk
 
 	return handle_logs()
 
-def use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text):
+def use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text, completion_tokens=0):
 	"""
 	Usage of LLM to answer Yes/No questions
 
@@ -130,6 +157,7 @@ def use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text):
 		psycopg2.connection (postgresql_connection): Database connnection
 		dict (config): Configuration dictionary using values from .yaml file
 		string (query_buffer): Set of Y/n questions
+		int (completion_tokens): Tokens reserved for the JSON answer
 
 	Returns:
 		LLM response in JSON format
@@ -142,7 +170,7 @@ def use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text):
 	]
 	try:
 		logger.debug(f"Asking these questions: {query_buffer}")
-		ai_msg = get_chat_completion(config, messages)
+		ai_msg = get_chat_completion(config, messages, completion_tokens=completion_tokens)
 		if ai_msg is None:
 			raise ValueError("Didn't get response from LM Studio")
 		jtext=ai_msg
@@ -171,25 +199,33 @@ def ask_llm_node_similarity(postgresql_connection, config, questions, text):
 	query_buffer_initial=f"TEXT: \"{text}\"\nQUESTIONS: ["
 	query_buffer=query_buffer_initial
 	system_prompt_for_y_n=select_prompt(postgresql_connection, config, 3, variables={})
-	if len(system_prompt_for_y_n) + len(query_buffer_initial) + 100 >= config.llm_max_tokens:
+	# Every question needs room for its answer in the JSON response, plus the braces around them
+	answer_tokens = getattr(config, 'llm_yes_no_answer_tokens', 12)
+	# We add 100 tokens to have a little room if we're leading with approximations
+	tokens_in_initial_buffer = count_tokens(config, system_prompt_for_y_n) + count_tokens(config, query_buffer_initial) + token_margin(config, 100) + answer_tokens
+	if tokens_in_initial_buffer + answer_tokens >= config.llm_max_tokens:
 		logger.error("Prompt for Y/n responses cannot be processes due to limited number of max tokens in configuration file")
 		return {}
 
 	llm_json_outputs = []
+	tokens_in_buffer = tokens_in_initial_buffer
+	questions_in_buffer = 0
 	for question in questions:
 		new_question=f"\"{question['questionId']}: {question['question']}\", "
-		tokens_in_question = len(system_prompt_for_y_n) + len(query_buffer) + len(new_question)
-		# We add 100 tokens to have a little room since we're leading with approximations
-		tokens_in_question = int(tokens_in_question * config.llm_tokens_per_100_characters / 100) + 100
-		if tokens_in_question > config.llm_max_tokens:
+		tokens_in_new_question = count_tokens(config, new_question) + answer_tokens
+		if tokens_in_buffer + tokens_in_new_question > config.llm_max_tokens:
 			if query_buffer_initial == query_buffer:
 				logger.error("Empty query buffer")
 			else:
-				llm_json_outputs.append(use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text))
+				llm_json_outputs.append(use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text, answer_tokens*(questions_in_buffer+1)))
 				query_buffer=query_buffer_initial
+				tokens_in_buffer = tokens_in_initial_buffer
+				questions_in_buffer = 0
 		query_buffer+=new_question
+		tokens_in_buffer+=tokens_in_new_question
+		questions_in_buffer+=1
 
-	llm_json_outputs.append(use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text))
+	llm_json_outputs.append(use_query_buffer_for_llm(postgresql_connection, config, query_buffer, text, answer_tokens*(questions_in_buffer+1)))
 
 	output = {}
 	for llm_output in llm_json_outputs:
@@ -558,15 +594,33 @@ def chat_loop_vector_questions(config, postgresql_connection):
 		if not user_input.strip():
 			print("Ask a question to the vector dataset or type '/bye' to exit")
 		else:
-			response = prettyfi_vector_search_with_llm(config, postgresql_connection, user_input) 
-			if response is None:
+			response = prettyfi_vector_search_with_llm(config, postgresql_connection, user_input, stream=True) 
+			if not print_streamed_response("Vector: ", response):
 				logger.error("Couldn't retrieve answer from LLM")
 				break
-			print("Vector: "+response)
 
 
 
-def prettyfi_vector_search_with_llm(config, postgresql_connection, question):
+def print_streamed_response(prefix, tokens):
+	"""
+	Prints an LLM response as its tokens arrive
+
+	Params:
+		string (prefix): Text printed before the response
+		iterable (tokens): Tokens of the LLM response
+
+	Returns:
+		string (response): Full response, or empty string if no token was received
+	"""
+	print(prefix, end='', flush=True)
+	response=[]
+	for token in tokens:
+		print(token, end='', flush=True)
+		response.append(token)
+	print()
+	return ''.join(response)
+
+def prettyfi_vector_search_with_llm(config, postgresql_connection, question, stream=False):
 	"""
 	Makes a vector similarity search of user question, then uses the vector response as context to power RAG
 
@@ -574,9 +628,10 @@ def prettyfi_vector_search_with_llm(config, postgresql_connection, question):
 		dict (config): Configuration dictionary using values from .yaml file
 		psycopg2.connection (postgresql_connection): Database connnection
 		string (question): User asked question
+		bool (stream): If True, the LLM response is returned as a generator of tokens
 
 	Returns:
-		string (text): Simplified text
+		string (text): Simplified text, or generator of its tokens if stream is True
 	"""
 	similar = vector_search(config, postgresql_connection, question)
 	context = similar['chunk'].tolist()
@@ -592,12 +647,15 @@ def prettyfi_vector_search_with_llm(config, postgresql_connection, question):
 		{"role": "user", "content": query}
 	]
 
+	if stream:
+		return stream_chat_completion(config, messages)
 	ai_msg = get_chat_completion(config, messages)
 	return ai_msg
 
 def vector_search(config, postgresql_connection, question):
 	"""
-	Makes a vector similarity search of user question
+	Makes a vector similarity search of user question. If vector_search_mode is 'hybrid', full-text matches are fused in the ranking.
+	If config.vector_search_filters selects files, only their chunks are ranked, by embedding distance
 
 	Params:
 		dict (config): Configuration dictionary using values from .yaml file
@@ -609,10 +667,45 @@ def vector_search(config, postgresql_connection, question):
 	"""
 	text = cleanWords(question)
 	question_embedding = get_embedding(config, text)
-	similar = cosine_vector_search(postgresql_connection, config, question_embedding)
+	filters = getattr(config, 'vector_search_filters', None)
+	if filters:
+		similar = cosine_vector_search(postgresql_connection, config, question_embedding, filters)
+	elif getattr(config, 'vector_search_mode', 'vector') == 'hybrid':
+		similar = hybrid_vector_search(postgresql_connection, config, question_embedding, question)
+	else:
+		similar = cosine_vector_search(postgresql_connection, config, question_embedding)
 	return similar
 
 
+def batch_vector_search(config, postgresql_connection, questions):
+	"""
+	Makes the vector similarity search of many questions: embeddings are requested in batches, and the nearest chunks of up to
+	vector_search_batch_size questions are fetched per query. Questions are always ranked by embedding distance
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		psycopg2.connection (postgresql_connection): Database connnection
+		list (questions): User asked questions
+
+	Returns:
+		list (similar): Vector database reply of each question, in the same order. None for questions that couldn't be searched
+	"""
+	embeddings = get_embeddings(config, [cleanWords(question) for question in questions])
+	similar = [None]*len(questions)
+	positions = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+	if len(positions) < len(questions):
+		logger.warning(f"{len(questions)-len(positions)} of {len(questions)} questions couldn't be embedded")
+	batch_size = getattr(config, 'vector_search_batch_size', 64)
+	for start in range(0, len(positions), batch_size):
+		batch = positions[start:start+batch_size]
+		results = batch_cosine_vector_search(postgresql_connection, config, [embeddings[i] for i in batch])
+		if results is None:
+			logger.error(f"Vector search failed for {len(batch)} questions")
+			continue
+		for i, result in zip(batch, results):
+			similar[i] = result
+	return similar
+
 def graph_system_prompt(postgresql_connection, config,  graph, rdf_additional_data):
 	"""
 	Creates LLM prompt for KG creation
@@ -711,7 +804,7 @@ def chat_loop_graph_questions(config, postgresql_connection, graph, rdf_addition
 		else:
 			response = graph_search(config, graph, system_prompt, user_input) 
 			if not response:
-				response="Could not retrieve information regarding the provided query"
+				print("Graph: Could not retrieve information regarding the provided query")
 			else:
 				query = f"Context: {response} Question: {user_input}"
 				logger.debug(f"Query to be processed by last step of KG: {query}")
@@ -720,8 +813,7 @@ def chat_loop_graph_questions(config, postgresql_connection, graph, rdf_addition
 					{"role": "user", "content": query}
 				]
 				logger.info("Calling LLM to interpret KG response")
-				response = get_chat_completion(config, messages)
-			print("Graph: "+response)
+				print_streamed_response("Graph: ", stream_chat_completion(config, messages))
 
 def chat_loop(config, postgresql_connection, graph, rdf_additional_data):
 	"""
@@ -779,5 +871,4 @@ def chat_loop(config, postgresql_connection, graph, rdf_additional_data):
 				{"role": "system", "content": system_prompt_for_both_responses},
 				{"role": "user", "content": query}
 			]
-			response = get_chat_completion(config, messages)
-			print("AI: "+response)
+			print_streamed_response("AI: ", stream_chat_completion(config, messages))
@@ -0,0 +1,250 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import numpy as np
+from pathlib import Path
+from base_logger import logger
+
+
+class SqliteLRUCache:
+	"""
+	Persistent key/value store kept in a SQLite table. When the number of entries goes over
+	max_entries, the least recently used entries are evicted
+
+	Params:
+		string (path): SQLite file. Relative paths are resolved from the project folder
+		string (table): Table name
+		int (max_entries): Maximum number of entries kept in the table
+	"""
+	def __init__(self, path, table, max_entries):
+		path=Path(path)
+		if not path.is_absolute():
+			path=Path(__file__).absolute().resolve().parent / path
+		self.table=table
+		self.max_entries=max_entries
+		self.hits=0
+		self.misses=0
+		self._lock=threading.Lock()
+		self._connection=sqlite3.connect(str(path), check_same_thread=False)
+		self._connection.execute("PRAGMA journal_mode=WAL;")
+		self._connection.execute("PRAGMA synchronous=NORMAL;")
+		self._connection.execute(f"""
+			CREATE TABLE IF NOT EXISTS {table} (
+				cache_key	TEXT PRIMARY KEY,
+				value		BLOB NOT NULL,
+				last_used	INTEGER NOT NULL
+			);
+		""")
+		self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used_idx ON {table} (last_used);")
+		self._connection.commit()
+		self._entries, self._clock = self._connection.execute(f"SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM {table};").fetchone()
+
+	def get_many(self, keys):
+		"""
+		Params:
+			list (keys): Cache keys
+
+		Returns:
+			list (values): Stored value per key, or None if the key isn't cached
+		"""
+		values=[None]*len(keys)
+		if not keys:
+			return values
+		with self._lock:
+			positions={}
+			for i, key in enumerate(keys):
+				positions.setdefault(key, []).append(i)
+			found=[]
+			unique_keys=list(positions.keys())
+			# SQLite limits the number of bound parameters per statement
+			for start in range(0, len(unique_keys), 500):
+				batch=unique_keys[start:start+500]
+				rows=self._connection.execute(f"SELECT cache_key, value FROM {self.table} WHERE cache_key IN ({','.join('?'*len(batch))});", batch).fetchall()
+				for key, value in rows:
+					found.append(key)
+					for i in positions[key]:
+						values[i]=value
+			if found:
+				self._clock+=1
+				self._connection.executemany(f"UPDATE {self.table} SET last_used=? WHERE cache_key=?;", [(self._clock, key) for key in found])
+				self._connection.commit()
+			hits=sum(1 for value in values if value is not None)
+			self.hits+=hits
+			self.misses+=len(values)-hits
+		return values
+
+	def get(self, key):
+		return self.get_many([key])[0]
+
+	def put_many(self, items):
+		"""
+		Params:
+			list (items): List of (key, value) tuples to store
+		"""
+		if not items:
+			return
+		with self._lock:
+			self._clock+=1
+			new_entries=0
+			for key, value in items:
+				cursor=self._connection.execute(f"UPDATE {self.table} SET value=?, last_used=? WHERE cache_key=?;", (value, self._clock, key))
+				if cursor.rowcount == 0:
+					self._connection.execute(f"INSERT INTO {self.table} (cache_key, value, last_used) VALUES (?, ?, ?);", (key, value, self._clock))
+					new_entries+=1
+			self._entries+=new_entries
+			if self.max_entries and self._entries > self.max_entries:
+				# Evicts a little more than required so eviction doesn't run on every insert
+				excess=self._entries - self.max_entries + max(1, self.max_entries // 20)
+				self._connection.execute(f"DELETE FROM {self.table} WHERE cache_key IN (SELECT cache_key FROM {self.table} ORDER BY last_used LIMIT ?);", (excess,))
+				self._entries=self._connection.execute(f"SELECT COUNT(*) FROM {self.table};").fetchone()[0]
+				logger.debug(f"Evicted entries from cache table {self.table}. Remaining entries: {self._entries}")
+			self._connection.commit()
+
+	def put(self, key, value):
+		self.put_many([(key, value)])
+
+	def close(self):
+		with self._lock:
+			self._connection.close()
+
+
+class EmbeddingCache(SqliteLRUCache):
+	"""
+	Content-addressed embedding cache. Embeddings are keyed by model name plus a hash of the embedded text, and stored as float32 blobs
+
+	Params:
+		string (path): SQLite file
+		int (max_entries): Maximum number of embeddings kept
+	"""
+	def __init__(self, path, max_entries):
+		super().__init__(path, 'embeddings', max_entries)
+
+	@staticmethod
+	def key(model_name, text):
+		return model_name + ':' + hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+	def get_embeddings(self, model_name, texts):
+		"""
+		Params:
+			string (model_name): Embedding model
+			list (texts): Embedded texts
+
+		Returns:
+			list (embeddings): Cached embedding per text, or None if the text isn't cached
+		"""
+		values=self.get_many([self.key(model_name, text) for text in texts])
+		return [None if value is None else np.frombuffer(value, dtype=np.float32) for value in values]
+
+	def put_embeddings(self, model_name, texts, embeddings):
+		"""
+		Params:
+			string (model_name): Embedding model
+			list (texts): Embedded texts
+			list (embeddings): Embedding per text. None values are skipped
+		"""
+		self.put_many([(self.key(model_name, text), np.asarray(embedding, dtype=np.float32).tobytes()) for text, embedding in zip(texts, embeddings) if embedding is not None])
+
+
+class CompletionCache(SqliteLRUCache):
+	"""
+	Cache of deterministic (temperature 0) chat completions. Completions are keyed by model name plus a hash of the request
+
+	Params:
+		string (path): SQLite file
+		int (max_entries): Maximum number of completions kept
+	"""
+	def __init__(self, path, max_entries):
+		super().__init__(path, 'completions', max_entries)
+
+	@staticmethod
+	def key(model_name, messages, options):
+		request=json.dumps({'messages': messages, 'options': options}, sort_keys=True, ensure_ascii=False)
+		return model_name + ':' + hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+	def get_completion(self, model_name, messages, options):
+		"""
+		Params:
+			string (model_name): Chat model
+			list (messages): Messages sent to LLM
+			dict (options): Any other request field that changes the response, e.g. temperature
+
+		Returns:
+			string (completion): Cached completion, or None if the request isn't cached
+		"""
+		value=self.get(self.key(model_name, messages, options))
+		if value is None:
+			return None
+		return value.decode('utf-8')
+
+	def put_completion(self, model_name, messages, options, completion):
+		self.put(self.key(model_name, messages, options), completion.encode('utf-8'))
+
+
+_cache_lock=threading.Lock()
+_embedding_cache=None
+_completion_cache=None
+
+def get_embedding_cache(config):
+	"""
+	Returns the embedding cache of this process, opening it the first time it's needed
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		EmbeddingCache (cache): Embedding cache, or None if the cache is disabled or couldn't be opened
+	"""
+	global _embedding_cache
+	path=getattr(config, 'embedding_cache_path', None)
+	if not path:
+		return None
+	with _cache_lock:
+		if _embedding_cache is None:
+			try:
+				_embedding_cache=EmbeddingCache(path, getattr(config, 'embedding_cache_max_entries', 0))
+			except Exception as ex:
+				logger.error(f"Embedding cache '{path}' couldn't be opened. Embeddings won't be cached: {ex}")
+				config.embedding_cache_path=None
+				return None
+		return _embedding_cache
+
+def get_completion_cache(config):
+	"""
+	Returns the chat completion cache of this process, opening it the first time it's needed.
+	The cache is opt-in: it's only used when config.llm_completion_cache_path is set and config.llm_completion_cache_bypass is not
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		CompletionCache (cache): Completion cache, or None if the cache is disabled or couldn't be opened
+	"""
+	global _completion_cache
+	path=getattr(config, 'llm_completion_cache_path', None)
+	if not path or getattr(config, 'llm_completion_cache_bypass', False):
+		return None
+	with _cache_lock:
+		if _completion_cache is None:
+			try:
+				_completion_cache=CompletionCache(path, getattr(config, 'llm_completion_cache_max_entries', 0))
+			except Exception as ex:
+				logger.error(f"Completion cache '{path}' couldn't be opened. Completions won't be cached: {ex}")
+				config.llm_completion_cache_path=None
+				return None
+		return _completion_cache
+
+def close_caches():
+	"""
+	Closes every cache opened by this process, logging its hit/miss counters
+	"""
+	global _embedding_cache, _completion_cache
+	with _cache_lock:
+		if _embedding_cache is not None:
+			logger.info(f"Embedding cache: {_embedding_cache.hits} hits, {_embedding_cache.misses} misses")
+			_embedding_cache.close()
+			_embedding_cache=None
+		if _completion_cache is not None:
+			logger.info(f"Completion cache: {_completion_cache.hits} hits, {_completion_cache.misses} misses")
+			_completion_cache.close()
+			_completion_cache=None
@@ -1,97 +1,487 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import threading
+import time
+import numpy as np
 from base_logger import logger
+from llm_cache import get_embedding_cache, get_completion_cache
+from token_counter import count_tokens, token_margin
+from local_embeddings import encode_texts
 
-def get_embedding(config, text):
+
+def endpoint_list(urls):
+	"""
+	Params:
+		string|list (urls): One endpoint, or a list of endpoints, as declared in .yaml file
+
+	Returns:
+		list: Endpoints
+	"""
+	if isinstance(urls, str):
+		return [urls]
+	return [url for url in urls if url]
+
+
+class EndpointPool:
+	"""
+	Set of equivalent endpoints. Each request goes to the healthy endpoint with the fewest outstanding
+	requests. Endpoints that fail repeatedly, or that are much slower than the fastest one, are removed
+	from the rotation for a cooldown period
+
+	Params:
+		list (urls): Endpoints
+		int (failure_threshold): Consecutive failures before an endpoint is removed
+		float (cooldown): Seconds an endpoint stays removed
+		float (slow_factor): An endpoint is removed when its average latency is this many times the one of the fastest endpoint. 0 disables it
+	"""
+	def __init__(self, urls, failure_threshold=3, cooldown=30.0, slow_factor=0.0):
+		self.endpoints=[{'url': url, 'outstanding': 0, 'failures': 0, 'latency': None, 'samples': 0, 'ejected_until': 0.0} for url in urls]
+		self.failure_threshold=failure_threshold
+		self.cooldown=cooldown
+		self.slow_factor=slow_factor
+		self._lock=threading.Lock()
+
+	def __len__(self):
+		return len(self.endpoints)
+
+	def acquire(self, exclude=()):
+		"""
+		Params:
+			list (exclude): Endpoints that shouldn't be selected, unless there isn't any other
+
+		Returns:
+			dict (endpoint): Selected endpoint. It must be given back with release
+		"""
+		with self._lock:
+			now=time.monotonic()
+			candidates=[e for e in self.endpoints if e['url'] not in exclude] or self.endpoints
+			healthy=[e for e in candidates if e['ejected_until'] <= now]
+			if healthy:
+				endpoint=min(healthy, key=lambda e: (e['outstanding'], e['latency'] or 0.0))
+			else:
+				# Every endpoint is removed: the one that comes back first is the best chance
+				endpoint=min(candidates, key=lambda e: e['ejected_until'])
+			endpoint['outstanding']+=1
+			return endpoint
+
+	def release(self, endpoint, success, elapsed=None):
+		"""
+		Params:
+			dict (endpoint): Endpoint returned by acquire
+			bool (success): Whether the request succeeded
+			float (elapsed): Seconds the request took
+		"""
+		with self._lock:
+			endpoint['outstanding']-=1
+			now=time.monotonic()
+			if not success:
+				endpoint['failures']+=1
+				if endpoint['failures'] >= self.failure_threshold:
+					endpoint['ejected_until']=now + self.cooldown
+					endpoint['failures']=0
+					logger.warning(f"Endpoint {endpoint['url']} removed for {self.cooldown}s after {self.failure_threshold} consecutive failures")
+				return
+			endpoint['failures']=0
+			if elapsed is None:
+				return
+			endpoint['samples']+=1
+			endpoint['latency']=elapsed if endpoint['latency'] is None else 0.8 * endpoint['latency'] + 0.2 * elapsed
+			if self.slow_factor and len(self.endpoints) > 1 and endpoint['samples'] >= 5:
+				others=[e['latency'] for e in self.endpoints if e is not endpoint and e['latency'] is not None and e['ejected_until'] <= now]
+				if others and endpoint['latency'] > self.slow_factor * min(others):
+					endpoint['ejected_until']=now + self.cooldown
+					# Starts over when it comes back, so old samples don't remove it again
+					endpoint['latency']=None
+					endpoint['samples']=0
+					logger.warning(f"Endpoint {endpoint['url']} removed for {self.cooldown}s for being slow")
+
+
+class LMStudioClient:
+	"""
+	HTTP client shared by every call made to LM Studio. It keeps a pool of keep-alive
+	connections so consecutive requests reuse the same TCP connection, and balances
+	requests among the endpoints declared for each call type
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+	"""
+	def __init__(self, config):
+		# Concurrent KG extraction must not wait on a free connection
+		pool_size=max(getattr(config, 'llm_pool_size', 10), getattr(config, 'kg_extraction_workers', 1))
+		connect_timeout=getattr(config, 'llm_connect_timeout', 5)
+		self.timeouts={
+			'embedding': (connect_timeout, getattr(config, 'llm_embedding_timeout', 60)),
+			'chat': (connect_timeout, getattr(config, 'llm_chat_timeout', None)),
+		}
+		pool_options={
+			'failure_threshold': getattr(config, 'llm_endpoint_failure_threshold', 3),
+			'cooldown': getattr(config, 'llm_endpoint_cooldown', 30),
+			'slow_factor': getattr(config, 'llm_endpoint_slow_factor', 0),
+		}
+		self.endpoints={
+			'embedding': EndpointPool(endpoint_list(config.llm_embedding_url), **pool_options),
+			'chat': EndpointPool(endpoint_list(config.llm_chat_url), **pool_options),
+		}
+		self.session=requests.Session()
+		hosts=len(self.endpoints['embedding']) + len(self.endpoints['chat'])
+		adapter=HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size, pool_block=True)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+
+	def send(self, data, call_type, timeout, stream=False):
+		"""
+		Sends a JSON request to the best endpoint of call_type. Connection errors, timeouts and server
+		errors are retried once per remaining endpoint
+
+		Params:
+			dict (data): Request body
+			string (call_type): Either 'embedding' or 'chat'
+			float|tuple (timeout): Timeout of this call. If None, the configured timeout of call_type is used
+			bool (stream): Whether the response body is streamed
+
+		Returns:
+			requests.Response (response): Successful response
+			dict (endpoint): Endpoint that answered. It must be given back with self.endpoints[call_type].release
+			float (start): time.monotonic() when the request was sent
+		"""
+		if timeout is None:
+			timeout=self.timeouts[call_type]
+		pool=self.endpoints[call_type]
+		body=json.dumps(data)
+		tried=[]
+		while True:
+			endpoint=pool.acquire(exclude=tried)
+			tried.append(endpoint['url'])
+			start=time.monotonic()
+			try:
+				response = self.session.post(endpoint['url'], data=body, timeout=timeout, stream=stream)
+				response.raise_for_status()
+				return response, endpoint, start
+			except requests.exceptions.RequestException as e:
+				server_side = not isinstance(e, requests.exceptions.HTTPError) or e.response is None or e.response.status_code >= 500
+				pool.release(endpoint, success=not server_side)
+				if not server_side or len(tried) >= len(pool):
+					raise
+				logger.warning(f"Request to {endpoint['url']} failed ({e}). Retrying with another endpoint...")
+
+	def post_json(self, data, call_type, timeout=None):
+		"""
+		Sends a JSON request and decodes the JSON response
+
+		Params:
+			dict (data): Request body
+			string (call_type): Either 'embedding' or 'chat'. Selects the endpoints and the default timeout
+			float|tuple (timeout): Timeout of this call. If None, the configured timeout of call_type is used
+
+		Returns:
+			dict: Decoded response
+		"""
+		response, endpoint, start = self.send(data, call_type, timeout)
+		success=False
+		try:
+			decoded=response.json()
+			success=True
+			return decoded
+		finally:
+			self.endpoints[call_type].release(endpoint, success, time.monotonic()-start)
+
+	def post_stream(self, data, call_type, timeout=None):
+		"""
+		Sends a JSON request whose response is a stream of server-sent events
+
+		Params:
+			dict (data): Request body
+			string (call_type): Either 'embedding' or 'chat'. Selects the endpoints and the default timeout
+			float|tuple (timeout): Timeout of this call. If None, the configured timeout of call_type is used
+
+		Returns:
+			Generator of dicts with the decoded data of each event
+		"""
+		response, endpoint, start = self.send(data, call_type, timeout, stream=True)
+		success=False
+		time_to_first_event=None
+		try:
+			with response:
+				# Server-sent events are always UTF-8, but without a charset in Content-Type requests would decode them as ISO-8859-1
+				response.encoding='utf-8'
+				# chunk_size=None hands over each chunk as soon as it arrives instead of waiting to fill a buffer
+				for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+					if not line or not line.startswith('data:'):
+						continue
+					if time_to_first_event is None:
+						time_to_first_event=time.monotonic()-start
+					payload=line[len('data:'):].strip()
+					if payload == '[DONE]':
+						break
+					yield json.loads(payload)
+			success=True
+		finally:
+			# Latency of a streamed answer depends on its length, so time-to-first-event is what gets compared
+			self.endpoints[call_type].release(endpoint, success, time_to_first_event)
+
+	def close(self):
+		self.session.close()
+
+_client=None
+_client_lock=threading.Lock()
+
+def create_client(config):
+	"""
+	Builds the shared LM Studio client. Any client previously created is closed
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		LMStudioClient (client): Shared client
+	"""
+	global _client
+	with _client_lock:
+		if _client is not None:
+			_client.close()
+		_client=LMStudioClient(config)
+	return _client
+
+def get_client(config):
+	"""
+	Returns the shared LM Studio client, building it from config the first time it's needed
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		LMStudioClient (client): Shared client
+	"""
+	global _client
+	with _client_lock:
+		if _client is None:
+			_client=LMStudioClient(config)
+		return _client
+
+def close_client():
+	"""
+	Closes the shared LM Studio client and its pooled connections
+	"""
+	global _client
+	with _client_lock:
+		if _client is not None:
+			_client.close()
+		_client=None
+
+def request_embeddings(config, inputs, timeout=None):
+	"""
+	Sends one request to the embeddings endpoint, or embeds in-process when config.embedding_backend is 'sentence_transformers'
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		string|list (inputs): Text, or list of texts, to embed
+		float|tuple (timeout): Timeout of this call. If None, the configured timeout is used
+
+	Returns:
+		list (embeddings): Text embeddings as float32 numpy arrays, in the same order as inputs
+	"""
+	if getattr(config, 'embedding_backend', 'lmstudio') == 'sentence_transformers':
+		return encode_texts(config, inputs if isinstance(inputs, list) else [inputs])
+	model_name=config.llm_embedding_model
+	data = {
+		"model": model_name,
+		"input": inputs
+	}
+	response = get_client(config).post_json(data, 'embedding', timeout=timeout)
+	if "data" not in response.keys(): 
+		raise ValueError("Response didn't include the block 'data'")
+	if not isinstance(response['data'], list):
+		raise ValueError("Response didn't include message list")
+	if not response['data']:
+		raise ValueError("Response replied with empty message list")
+	expected_len=len(inputs) if isinstance(inputs, list) else 1
+	if len(response['data']) != expected_len:
+		raise ValueError(f"Response included {len(response['data'])} embeddings, expected {expected_len}")
+	embeddings=[None]*expected_len
+	for position, item in enumerate(response['data']):
+		if "embedding" not in item.keys(): 
+			raise ValueError("Response didn't include the block 'embedding'")
+		embeddings[item.get('index', position)]=np.asarray(item['embedding'], dtype=np.float32)
+	return embeddings
+
+def embedding_model_name(config):
+	"""
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		string: Name of the model that embeds texts with the configured backend
+	"""
+	if getattr(config, 'embedding_backend', 'lmstudio') == 'sentence_transformers':
+		return config.local_embedding_model
+	return config.llm_embedding_model
+
+def get_embedding(config, text, timeout=None):
 	"""
 	Gets embedding of text
 
 	Params:
 		dict (config): Configuration dictionary using values from .yaml file
 		string (text): Text to embed
+		float|tuple (timeout): Timeout of this call. If None, the configured timeout is used
 
 	Returns:
-		list (embedding): Text embedding
+		numpy.ndarray (embedding): Text embedding (float32)
 	"""
 	try:
-		model_name=config.llm_embedding_model
 		if not text:
 			logger.warning("Text to embed is epmpty string")
-		url = config.llm_embedding_url
-		headers = {"Content-Type": "application/json"}
-		data = {
-			"model": model_name,
-			"input": text
-		}
-		response = requests.post(url, headers=headers, data=json.dumps(data))
-		response.raise_for_status()
-		if "data" not in response.json().keys(): 
-			raise ValueError("Response didn't include the block 'data'")
-		if not isinstance(response.json()['data'], list):
-			raise ValueError("Response didn't include message list")
-		if not response.json()['data']:
-			raise ValueError("Response replied with empty message list")
-		if "embedding" not in response.json()['data'][0].keys(): 
-			raise ValueError("Response didn't include the block 'embedding'")
-		return response.json()['data'][0]['embedding']
+		cache=get_embedding_cache(config)
+		if cache is not None:
+			embedding=cache.get_embeddings(embedding_model_name(config), [text])[0]
+			if embedding is not None:
+				return embedding
+		embedding=request_embeddings(config, text, timeout=timeout)[0]
+		if cache is not None:
+			cache.put_embeddings(embedding_model_name(config), [text], [embedding])
+		return embedding
 	except requests.exceptions.RequestException as e:
 		logger.error( f"Request error: {e}")
 		return None
 	except ValueError as ve:
 		logger.error(f"Validation error: {ve}")
 		return None
-	except KeyError:
+	except (KeyError, IndexError):
 		logger.error( "Unexpected response format")
 		return None
 	except Exception as ex:
 		logger.error( f"An error occurred: {ex}")
 		return None
 
-def get_chat_completion(config, messages=[]):
+def split_embedding_batches(config, texts):
 	"""
-	Manager of LLM prompts
+	Groups texts in batches that respect both the maximum number of inputs per request and the token budget per request
 
 	Params:
 		dict (config): Configuration dictionary using values from .yaml file
-		list (messages): Set of messages sent to LLM, where there's at least one 'role' and one 'content' message
+		list (texts): Texts to embed
 
 	Returns:
-		list (embedding): LLM response
+		list (batches): List of batches, where each batch is a list of positions in texts
 	"""
-	try:
-		model_name=config.llm_chat_model
-		if not isinstance(messages, list) or not all(isinstance(msg, dict) and "role" in msg and "content" in msg for msg in messages):
-			raise ValueError("messages must be a list of dictionaries with 'role' and 'content' keys")
-		
-		if not any(msg["role"] == "system" for msg in messages):
-			raise ValueError("messages must contain at least one dictionary with role 'system'")
-		
-		if not any(msg["role"] == "user" for msg in messages):
-			raise ValueError("messages must contain at least one dictionary with role 'user'")
+	batch_size=max(1, getattr(config, 'llm_embedding_batch_size', 1))
+	batch_tokens=getattr(config, 'llm_embedding_batch_tokens', config.llm_embedding_context_len)
+	batches=[]
+	batch=[]
+	tokens_in_batch=0
+	for i, text in enumerate(texts):
+		tokens_in_text = count_tokens(config, text) + 1
+		if batch and (len(batch) >= batch_size or tokens_in_batch + tokens_in_text > batch_tokens):
+			batches.append(batch)
+			batch=[]
+			tokens_in_batch=0
+		batch.append(i)
+		tokens_in_batch+=tokens_in_text
+	if batch:
+		batches.append(batch)
+	return batches
+
+def get_embeddings(config, texts):
+	"""
+	Gets embeddings of a list of texts, sending them in batches to the embeddings endpoint.
+	If a batch fails, its texts are embedded one by one so a single bad input only affects its own position
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		list (texts): Texts to embed
+
+	Returns:
+		list (embeddings): Text embeddings (float32 numpy arrays) in the same order as texts. Positions that couldn't be embedded are None
+	"""
+	embeddings=[None]*len(texts)
+	cache=get_embedding_cache(config)
+	if cache is not None:
+		embeddings=cache.get_embeddings(embedding_model_name(config), texts)
+	# Positions in texts that still need to be requested
+	pending=[i for i, embedding in enumerate(embeddings) if embedding is None]
+	if len(pending) < len(texts):
+		logger.debug(f"{len(texts)-len(pending)} of {len(texts)} embeddings found in cache")
+	pending_texts=[texts[i] for i in pending]
+	for batch in split_embedding_batches(config, pending_texts):
+		batch=[pending[j] for j in batch]
+		try:
+			if not all(texts[i] for i in batch):
+				logger.warning("At least one text to embed is epmpty string")
+			batch_embeddings=request_embeddings(config, [texts[i] for i in batch])
+			for i, embedding in zip(batch, batch_embeddings):
+				embeddings[i]=embedding
+		except Exception as ex:
+			if len(batch)==1:
+				logger.error(f"Text in position {batch[0]} couldn't be embedded: {ex}")
+				continue
+			logger.warning(f"Batch of {len(batch)} texts couldn't be embedded ({ex}). Retrying each text individually...")
+			for i in batch:
+				embeddings[i]=get_embedding(config, texts[i])
+				if embeddings[i] is None:
+					logger.error(f"Text in position {i} couldn't be embedded")
+	if cache is not None and pending:
+		cache.put_embeddings(embedding_model_name(config), pending_texts, [embeddings[i] for i in pending])
+	return embeddings
+
+def validate_chat_messages(config, messages, completion_tokens=0):
+	"""
+	Validates the messages of a chat request, including their approximate number of tokens.
+	Raises ValueError if validation fails
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		list (messages): Set of messages sent to LLM, where there's at least one 'role' and one 'content' message
+		int (completion_tokens): Tokens that must be left for the response
+	"""
+	if not isinstance(messages, list) or not all(isinstance(msg, dict) and "role" in msg and "content" in msg for msg in messages):
+		raise ValueError("messages must be a list of dictionaries with 'role' and 'content' keys")
+	
+	if not any(msg["role"] == "system" for msg in messages):
+		raise ValueError("messages must contain at least one dictionary with role 'system'")
+	
+	if not any(msg["role"] == "user" for msg in messages):
+		raise ValueError("messages must contain at least one dictionary with role 'user'")
 
-		query_length = 0
-		for msg in messages:
-			if "content" not in msg.keys():
-				raise ValueError("messages must contain variable 'content'")
-			query_length+=len(msg["content"])
+	query_tokens = 0
+	for msg in messages:
+		if "content" not in msg.keys():
+			raise ValueError("messages must contain variable 'content'")
+		query_tokens+=count_tokens(config, msg["content"])
 
-		# We add 50 tokens since we are working with approximations
-		query_tokens = int(query_length * config.llm_tokens_per_100_characters / 100) + 50
-		if query_tokens  > config.llm_max_tokens:
-			error_msg=f"""Cannot process since the number of tokens surpasses the
-			limit stablished in the config.yaml file. 
+	# We add 50 tokens if we are working with approximations
+	query_tokens += token_margin(config, 50) + completion_tokens
+	if query_tokens  > config.llm_max_tokens:
+		error_msg=f"""Cannot process since the number of tokens surpasses the
+		limit stablished in the config.yaml file. 
 
-			requesting message: {messages}
+		requesting message: {messages}
 
-			Query Tokens: {query_tokens}
+		Query Tokens: {query_tokens}
 
-			LLM Token Limit: {config.llm_max_tokens}
+		LLM Token Limit: {config.llm_max_tokens}
+
+		"""
+		raise ValueError(error_msg)
+
+def get_chat_completion(config, messages=[], timeout=None, completion_tokens=0):
+	"""
+	Manager of LLM prompts
 
-			"""
-			raise ValueError(error_msg)
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		list (messages): Set of messages sent to LLM, where there's at least one 'role' and one 'content' message
+		float|tuple (timeout): Timeout of this call. If None, the configured timeout is used
+		int (completion_tokens): Tokens that must be left for the response within llm_max_tokens
+
+	Returns:
+		list (embedding): LLM response
+	"""
+	try:
+		model_name=config.llm_chat_model
+		validate_chat_messages(config, messages, completion_tokens)
 		
-		url = config.llm_chat_url
-		headers = {"Content-Type": "application/json"}
 		data = {
 			"model": model_name,
 			"messages": messages,
@@ -99,22 +489,30 @@ def get_chat_completion(config, messages=[]):
 			"max_tokens": -1,
 			"stream": False
 		}
+		cache_options = {"temperature": data["temperature"], "max_tokens": data["max_tokens"]}
+		cache = get_completion_cache(config)
+		if cache is not None:
+			completion = cache.get_completion(model_name, messages, cache_options)
+			if completion is not None:
+				return completion
 		#logger.debug(messages)
 		#logger.debug(f"Query Tokens: {query_tokens}")
 		#logger.debug(f"query_length: {query_length}")
-		response = requests.post(url, headers=headers, data=json.dumps(data))
-		response.raise_for_status()
-		if "choices" not in response.json().keys(): 
+		response = get_client(config).post_json(data, 'chat', timeout=timeout)
+		if "choices" not in response.keys(): 
 			raise ValueError("Response didn't include the block 'choices'")
-		if not isinstance(response.json()['choices'], list):
+		if not isinstance(response['choices'], list):
 			raise ValueError("Response didn't include message list")
-		if not response.json()['choices']:
+		if not response['choices']:
 			raise ValueError("Response replied with empty message list")
-		if "message" not in response.json()['choices'][0].keys(): 
+		if "message" not in response['choices'][0].keys(): 
 			raise ValueError("Response didn't include the block 'message'")
-		if "content" not in response.json()['choices'][0]['message'].keys(): 
+		if "content" not in response['choices'][0]['message'].keys(): 
 			raise ValueError("Response didn't include the block 'content'")
-		return response.json()['choices'][0]['message']['content']
+		completion = response['choices'][0]['message']['content']
+		if cache is not None and isinstance(completion, str):
+			cache.put_completion(model_name, messages, cache_options, completion)
+		return completion
 	
 	except requests.exceptions.RequestException as e:
 		logger.error( f"Request error: {e}")
@@ -128,3 +526,54 @@ def get_chat_completion(config, messages=[]):
 	except Exception as ex:
 		logger.error( f"An error occurred: {ex}")
 		return None
+
+def stream_chat_completion(config, messages=[], timeout=None):
+	"""
+	Manager of LLM prompts whose response is streamed. Tokens are yielded as soon as
+	the server sends them through server-sent events
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		list (messages): Set of messages sent to LLM, where there's at least one 'role' and one 'content' message
+		float|tuple (timeout): Timeout of this call. If None, the configured timeout is used
+
+	Returns:
+		Generator of strings (tokens) with the LLM response. Nothing else is yielded after an error
+	"""
+	try:
+		model_name=config.llm_chat_model
+		validate_chat_messages(config, messages)
+
+		data = {
+			"model": model_name,
+			"messages": messages,
+			"temperature": 0,
+			"max_tokens": -1,
+			"stream": True
+		}
+		cache_options = {"temperature": data["temperature"], "max_tokens": data["max_tokens"]}
+		cache = get_completion_cache(config)
+		if cache is not None:
+			completion = cache.get_completion(model_name, messages, cache_options)
+			if completion is not None:
+				yield completion
+				return
+		completion = []
+		for event in get_client(config).post_stream(data, 'chat', timeout=timeout):
+			if "choices" not in event.keys() or not event['choices']:
+				continue
+			token = event['choices'][0].get('delta', {}).get('content')
+			if token:
+				completion.append(token)
+				yield token
+		if cache is not None and completion:
+			cache.put_completion(model_name, messages, cache_options, ''.join(completion))
+
+	except requests.exceptions.RequestException as e:
+		logger.error( f"Request error: {e}")
+	except ValueError as ve:
+		logger.error(f"Validation error: {ve}")
+	except (KeyError, AttributeError):
+		logger.error( "Unexpected response format")
+	except Exception as ex:
+		logger.error( f"An error occurred: {ex}")
@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+from base_logger import logger
+
+try:
+	from sentence_transformers import SentenceTransformer
+except ImportError:
+	SentenceTransformer = None
+
+
+_model=None
+_model_lock=threading.Lock()
+
+def get_local_model(config):
+	"""
+	Loads, once per process, the sentence-transformers model used to embed texts on CPU
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		sentence_transformers.SentenceTransformer (model): Embedding model
+	"""
+	global _model
+	with _model_lock:
+		if _model is None:
+			if SentenceTransformer is None:
+				raise ImportError("Package 'sentence-transformers' is required when embedding_backend is 'sentence_transformers'")
+			import torch
+			threads=getattr(config, 'local_embedding_threads', 0)
+			if threads:
+				torch.set_num_threads(threads)
+			logger.info(f"Loading local embedding model {config.local_embedding_model} on CPU using {torch.get_num_threads()} threads")
+			_model=SentenceTransformer(config.local_embedding_model, device='cpu')
+			dimension=_model.get_sentence_embedding_dimension()
+			if dimension != config.llm_embedding_vector_len:
+				logger.error(f"Local embedding model returns vectors of length {dimension}, but llm_embedding_vector_len is {config.llm_embedding_vector_len}")
+		return _model
+
+def encode_texts(config, texts):
+	"""
+	Embeds a list of texts in-process. Same output as lmstudio.request_embeddings
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		list (texts): Texts to embed
+
+	Returns:
+		list (embeddings): Text embeddings as float32 numpy arrays, in the same order as texts
+	"""
+	model=get_local_model(config)
+	embeddings=model.encode(texts, batch_size=getattr(config, 'local_embedding_batch_size', 32), convert_to_numpy=True, show_progress_bar=False)
+	return list(np.asarray(embeddings, dtype=np.float32))
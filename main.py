@@ -9,7 +9,11 @@ from firstread import graph_from_pdf_directory, read_ontology
 from interactions import chat_loop_vector_questions, chat_loop_graph_questions, chat_loop
 from tools import clean_node_metadata, remove_special_chars_in_llm_output, get_local_name
 from rdf_interface import search_rdf_classes_objects
-from postgresql import  create_connection, create_insert_prompt_tables
+from memgraph_interface import ensure_graph_indexes, return_graph_labels
+from postgresql import  create_connection_pool, create_insert_prompt_tables, create_vector_index, vector_index_info
+from lmstudio import create_client, close_client
+from llm_cache import close_caches
+from token_counter import get_token_counter
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
@@ -34,6 +38,12 @@ def local_parser():
     parser.add_argument("-g", "--graph-chat", action='store_true', help="Chat with the Knowledge Graph through LLM. Compatible with --ontology")
     parser.add_argument("-o", "--ontology", action='store_true', help="Incorporates ontolgy when creating knowledge graph")
     parser.add_argument("-c", "--chat", action='store_true', help="*Experimental* Chat with both Knowledge Graph and Vector Dataset through LLM. Compatible with --ontology")
+    parser.add_argument("--vector-index", choices=['show', 'rebuild'], help="Shows the indexes of the vector table, or rebuilds its ANN index using the settings in .yaml file")
+    parser.add_argument("--graph-index", choices=['show', 'create'], help="Shows the indexes and constraints the knowledge graph needs for the labels in use, or creates the missing ones")
+    parser.add_argument("--filter-file", action='append', metavar='FILE', help="Restricts vector search to chunks of this PDF file (name or full path). Can be repeated")
+    parser.add_argument("--filter-file-id", action='append', metavar='FILE_ID', help="Restricts vector search to chunks of this file ID. Can be repeated")
+    parser.add_argument("--filter-batch", action='append', metavar='BATCH', help="Restricts vector search to chunks loaded by this ingestion batch. Can be repeated")
+    parser.add_argument("--no-llm-cache", action='store_true', help="Bypasses the LLM completion cache declared in .yaml file, neither reading nor writing it")
     return parser
 
 
@@ -80,6 +90,18 @@ def check_file_existance(filename:str, fileTypes:list[str]) -> tuple[int, str]:
 # Validates configuration. 
 # [1, 100] for warnings
 # >100 if there are crtitical flaws
+def is_endpoint_list(urls):
+    """
+    Params:
+        string|list (urls): Value of an endpoint parameter
+
+    Returns:
+        bool: True if urls is a non-empty string or a non-empty list of non-empty strings
+    """
+    if isinstance(urls, str):
+        return bool(urls)
+    return isinstance(urls, list) and len(urls)>0 and all(isinstance(url, str) and url for url in urls)
+
 def validate_config(config):
     """
     Validation of local config.yaml file
@@ -123,6 +145,8 @@ def validate_config(config):
         tokens_in_prompt = ceil(config.llm_len_prompt_engineering * config.llm_tokens_per_100_characters / 100)
         if tokens_in_prompt > config.llm_max_tokens:
             validations[111]=f'Parameter "llm_len_prompt_engineering" uses {tokens_in_prompt} tokens, however {config.llm_max_tokens} is configured to be the maximum'
+        elif isinstance(getattr(config, 'llm_kg_answer_tokens', 2048), int) and tokens_in_prompt + getattr(config, 'llm_kg_answer_tokens', 2048) >= config.llm_max_tokens:
+            validations[201]=f'Parameters "llm_len_prompt_engineering" and "llm_kg_answer_tokens" use {tokens_in_prompt + getattr(config, "llm_kg_answer_tokens", 2048)} tokens, leaving no room for text chunks within "llm_max_tokens" ({config.llm_max_tokens})'
     if not hasattr(config, 'k_most_similar'):
         validations[112]='Parameter "k_most_similar" not found. '
     elif not isinstance(config.k_most_similar, int) or config.k_most_similar<=0:
@@ -157,8 +181,8 @@ def validate_config(config):
         validations[122]='Parameter "llm_embedding_model" MUST be a non-empty string. '
     if not hasattr(config, 'llm_embedding_url'):
         validations[123]='Parameter "llm_embedding_url" not found. '
-    elif not isinstance(config.llm_embedding_url, str) or not config.llm_embedding_url:
-        validations[124]='Parameter "llm_embedding_url" MUST be a non-empty string. '
+    elif not is_endpoint_list(config.llm_embedding_url):
+        validations[124]='Parameter "llm_embedding_url" MUST be a non-empty string or a non-empty list of non-empty strings. '
     if not hasattr(config, 'llm_embedding_vector_len'):
         validations[125]='Parameter "llm_embedding_vector_len" not found. '
     elif not isinstance(config.llm_embedding_vector_len, int) or config.llm_embedding_vector_len<=0:
@@ -167,14 +191,96 @@ def validate_config(config):
         validations[127]='Parameter "llm_embedding_context_len" not found. '
     elif not isinstance(config.llm_embedding_context_len, int):
         validations[128]='Parameter "llm_embedding_context_len" can only be an INTEGER'
+    if hasattr(config, 'embedding_backend') and config.embedding_backend not in ['lmstudio', 'sentence_transformers']:
+        validations[169]='Parameter "embedding_backend" can ONLY be either "lmstudio" or "sentence_transformers". '
+    elif getattr(config, 'embedding_backend', 'lmstudio') == 'sentence_transformers':
+        if not isinstance(getattr(config, 'local_embedding_model', None), str) or not config.local_embedding_model:
+            validations[170]='Parameter "local_embedding_model" MUST be a non-empty string when "embedding_backend" is "sentence_transformers". '
+        if not isinstance(getattr(config, 'local_embedding_threads', 0), int) or getattr(config, 'local_embedding_threads', 0)<0:
+            validations[171]='Parameter "local_embedding_threads" can only be an INTEGER greater than or equal to zero. '
+        if not isinstance(getattr(config, 'local_embedding_batch_size', 32), int) or getattr(config, 'local_embedding_batch_size', 32)<=0:
+            validations[172]='Parameter "local_embedding_batch_size" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'llm_embedding_batch_size') and (not isinstance(config.llm_embedding_batch_size, int) or config.llm_embedding_batch_size<=0):
+        validations[158]='Parameter "llm_embedding_batch_size" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'llm_embedding_batch_tokens') and (not isinstance(config.llm_embedding_batch_tokens, int) or config.llm_embedding_batch_tokens<=0):
+        validations[159]='Parameter "llm_embedding_batch_tokens" can only be an INTEGER greater than zero. '
     if not hasattr(config, 'llm_chat_model'):
         validations[129]='Parameter "llm_chat_model" not found. '
     elif not isinstance(config.llm_chat_model, str) or not config.llm_chat_model:
         validations[130]='Parameter "llm_chat_model" MUST be a non-empty string. '
     if not hasattr(config, 'llm_chat_url'):
         validations[131]='Parameter "llm_chat_url" not found. '
-    elif not isinstance(config.llm_chat_url, str) or not config.llm_chat_url:
-        validations[132]='Parameter "llm_chat_url" MUST be a non-empty string. '
+    elif not is_endpoint_list(config.llm_chat_url):
+        validations[132]='Parameter "llm_chat_url" MUST be a non-empty string or a non-empty list of non-empty strings. '
+    if hasattr(config, 'embedding_cache_max_entries') and (not isinstance(config.embedding_cache_max_entries, int) or config.embedding_cache_max_entries<0):
+        validations[166]='Parameter "embedding_cache_max_entries" can only be an INTEGER greater than or equal to zero. '
+    if hasattr(config, 'llm_completion_cache_max_entries') and (not isinstance(config.llm_completion_cache_max_entries, int) or config.llm_completion_cache_max_entries<0):
+        validations[167]='Parameter "llm_completion_cache_max_entries" can only be an INTEGER greater than or equal to zero. '
+    if hasattr(config, 'llm_token_safety_margin') and (not isinstance(config.llm_token_safety_margin, int) or config.llm_token_safety_margin<0):
+        validations[168]='Parameter "llm_token_safety_margin" can only be an INTEGER greater than or equal to zero. '
+    if hasattr(config, 'llm_yes_no_answer_tokens') and (not isinstance(config.llm_yes_no_answer_tokens, int) or config.llm_yes_no_answer_tokens<=0):
+        validations[198]='Parameter "llm_yes_no_answer_tokens" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'llm_kg_answer_tokens') and (not isinstance(config.llm_kg_answer_tokens, int) or config.llm_kg_answer_tokens<=0):
+        validations[199]='Parameter "llm_kg_answer_tokens" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'llm_embedding_context_margin') and (not isinstance(config.llm_embedding_context_margin, (int, float)) or not 0 <= config.llm_embedding_context_margin < 1):
+        validations[200]='Parameter "llm_embedding_context_margin" can only be a NUMBER in range [ 0, 1 ). '
+    if hasattr(config, 'llm_tokenizer_path') and config.llm_tokenizer_path and not os.path.exists(config.llm_tokenizer_path):
+        validations[6]='Parameter "llm_tokenizer_path" does not exist. Token counts will use "llm_tokens_per_100_characters"'
+    if hasattr(config, 'llm_pool_size') and (not isinstance(config.llm_pool_size, int) or config.llm_pool_size<=0):
+        validations[160]='Parameter "llm_pool_size" can only be an INTEGER greater than zero. '
+    for i, timeout_key in enumerate(['llm_connect_timeout', 'llm_embedding_timeout', 'llm_chat_timeout']):
+        timeout_value = getattr(config, timeout_key, None)
+        if timeout_value is not None and (not isinstance(timeout_value, (int, float)) or timeout_value<=0):
+            validations[161+i]=f'Parameter "{timeout_key}" can only be empty or a NUMBER greater than zero. '
+    if hasattr(config, 'llm_endpoint_failure_threshold') and (not isinstance(config.llm_endpoint_failure_threshold, int) or config.llm_endpoint_failure_threshold<=0):
+        validations[173]='Parameter "llm_endpoint_failure_threshold" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'llm_endpoint_cooldown') and (not isinstance(config.llm_endpoint_cooldown, (int, float)) or config.llm_endpoint_cooldown<0):
+        validations[174]='Parameter "llm_endpoint_cooldown" can only be a NUMBER greater than or equal to zero. '
+    if hasattr(config, 'llm_endpoint_slow_factor') and (not isinstance(config.llm_endpoint_slow_factor, (int, float)) or (config.llm_endpoint_slow_factor!=0 and config.llm_endpoint_slow_factor<=1)):
+        validations[175]='Parameter "llm_endpoint_slow_factor" can only be 0 or a NUMBER greater than one. '
+    if hasattr(config, 'vector_copy_batch_size') and (not isinstance(config.vector_copy_batch_size, int) or config.vector_copy_batch_size<=0):
+        validations[176]='Parameter "vector_copy_batch_size" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'vector_copy_format') and config.vector_copy_format not in ['binary', 'text']:
+        validations[177]='Parameter "vector_copy_format" can ONLY be either "binary" or "text". '
+    if hasattr(config, 'vector_build_mode') and config.vector_build_mode not in ['rebuild', 'incremental']:
+        validations[187]='Parameter "vector_build_mode" can ONLY be either "rebuild" or "incremental". '
+    if hasattr(config, 'vector_search_mode') and config.vector_search_mode not in ['vector', 'hybrid']:
+        validations[188]='Parameter "vector_search_mode" can ONLY be either "vector" or "hybrid". '
+    for i, hybrid_key in enumerate(['hybrid_rrf_k', 'hybrid_candidates']):
+        if hasattr(config, hybrid_key) and (not isinstance(getattr(config, hybrid_key), int) or getattr(config, hybrid_key)<=0):
+            validations[189+i]=f'Parameter "{hybrid_key}" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'vector_partitions') and (not isinstance(config.vector_partitions, int) or config.vector_partitions<0):
+        validations[191]='Parameter "vector_partitions" can only be an INTEGER greater than or equal to zero. '
+    if hasattr(config, 'vector_iterative_scan') and config.vector_iterative_scan not in ['off', 'relaxed_order', 'strict_order']:
+        validations[192]='Parameter "vector_iterative_scan" can ONLY be "off", "relaxed_order" or "strict_order". '
+    if getattr(config, 'vector_ingestion_batch', None) is not None and (not isinstance(config.vector_ingestion_batch, str) or len(config.vector_ingestion_batch)>64):
+        validations[193]='Parameter "vector_ingestion_batch" can only be empty or a string of up to 64 characters. '
+    if hasattr(config, 'vector_storage') and config.vector_storage not in ['full', 'halfvec', 'binary']:
+        validations[194]='Parameter "vector_storage" can ONLY be "full", "halfvec" or "binary". '
+    if hasattr(config, 'rerank_candidates') and (not isinstance(config.rerank_candidates, int) or config.rerank_candidates<=0):
+        validations[195]='Parameter "rerank_candidates" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'vector_search_batch_size') and (not isinstance(config.vector_search_batch_size, int) or config.vector_search_batch_size<=0):
+        validations[196]='Parameter "vector_search_batch_size" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'db_fetch_size') and (not isinstance(config.db_fetch_size, int) or config.db_fetch_size<=0):
+        validations[197]='Parameter "db_fetch_size" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'vector_index_type') and config.vector_index_type not in ['hnsw', 'ivfflat', 'none']:
+        validations[178]='Parameter "vector_index_type" can ONLY be "hnsw", "ivfflat" or "none". '
+    elif getattr(config, 'vector_index_type', 'none') == 'ivfflat' and getattr(config, 'vector_iterative_scan', 'off') == 'strict_order':
+        validations[202]='Parameter "vector_iterative_scan" can ONLY be "off" or "relaxed_order" when "vector_index_type" is "ivfflat". '
+    for i, index_key in enumerate(['vector_hnsw_m', 'vector_hnsw_ef_construction', 'vector_hnsw_ef_search', 'vector_ivfflat_probes']):
+        if hasattr(config, index_key) and (not isinstance(getattr(config, index_key), int) or getattr(config, index_key)<=0):
+            validations[179+i]=f'Parameter "{index_key}" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'vector_ivfflat_lists') and (not isinstance(config.vector_ivfflat_lists, int) or config.vector_ivfflat_lists<0):
+        validations[183]='Parameter "vector_ivfflat_lists" can only be an INTEGER greater than or equal to zero. '
+    for i, pool_key in enumerate(['db_pool_size', 'db_pool_min_size']):
+        if hasattr(config, pool_key) and (not isinstance(getattr(config, pool_key), int) or getattr(config, pool_key)<=0):
+            validations[184+i]=f'Parameter "{pool_key}" can only be an INTEGER greater than zero. '
+    if getattr(config, 'db_pool_timeout', None) is not None and (not isinstance(config.db_pool_timeout, (int, float)) or config.db_pool_timeout<=0):
+        validations[186]='Parameter "db_pool_timeout" can only be empty or a NUMBER greater than zero. '
+    if hasattr(config, 'kg_extraction_workers') and (not isinstance(config.kg_extraction_workers, int) or config.kg_extraction_workers<=0):
+        validations[164]='Parameter "kg_extraction_workers" can only be an INTEGER greater than zero. '
+    if hasattr(config, 'kg_max_in_flight') and (not isinstance(config.kg_max_in_flight, int) or config.kg_max_in_flight<=0):
+        validations[165]='Parameter "kg_max_in_flight" can only be an INTEGER greater than zero. '
     if not hasattr(config, 'db_name'):
         validations[133]='Parameter "db_name" not found. '
     elif not isinstance(config.db_name, str) or not config.db_name:
@@ -261,6 +367,23 @@ def additional_variables_setup(config):
     Returns:
         dict (config): Updated config file
     """
+    # llm_len_prompt_engineering is measured in characters
+    tokens_in_prompt = ceil(config.llm_len_prompt_engineering * config.llm_tokens_per_100_characters / 100)
+    # Room left for the JSON answer of each knowledge graph extraction
+    tokens_for_graph_chunk = config.llm_max_tokens - tokens_in_prompt - getattr(config, 'llm_kg_answer_tokens', 2048)
+    if get_token_counter(config).exact:
+        # Chunk sizes are measured in tokens, so they don't need the room left for approximations
+        config.chunk_length_unit = 'tokens'
+        config.chunk_size = int((config.llm_max_tokens - tokens_in_prompt) / config.k_most_similar)
+        # Chunks are counted with the chat model tokenizer, which doesn't match the embedding model vocabulary
+        embedding_chunk_limit = int(config.llm_embedding_context_len * (1 - getattr(config, 'llm_embedding_context_margin', 0.25)))
+        if config.chunk_size > embedding_chunk_limit:
+            config.chunk_size = embedding_chunk_limit
+        config.chunk_overlap = int(config.chunk_overlap_ratio * config.chunk_size)
+        config.chunk_size_graph = tokens_for_graph_chunk
+        config.chunk_overlap_graph = int(config.chunk_overlap_ratio * config.chunk_size_graph)
+        return config
+    config.chunk_length_unit = 'characters'
     config.chunk_size = int((config.llm_max_tokens - config.llm_len_prompt_engineering) / config.k_most_similar)
     config.chunk_size = int(config.chunk_size * 100 / config.llm_tokens_per_100_characters)
     if config.chunk_size > config.llm_embedding_context_len:
@@ -271,6 +394,8 @@ def additional_variables_setup(config):
     # Closest to 10, to have a little room to avoid truncation
     config.chunk_overlap = config.chunk_overlap - (  config.chunk_overlap%10  )
     config.chunk_size_graph = config.llm_max_tokens - config.llm_len_prompt_engineering
+    if config.chunk_size_graph > int(tokens_for_graph_chunk * 100 / config.llm_tokens_per_100_characters):
+        config.chunk_size_graph = int(tokens_for_graph_chunk * 100 / config.llm_tokens_per_100_characters)
     # Closest to 50, to have a little room to avoid truncation
     config.chunk_size_graph = config.chunk_size_graph - (  config.chunk_size_graph%50  )
     config.chunk_overlap_graph = int(config.chunk_overlap_ratio * config.chunk_size_graph)
@@ -368,8 +493,8 @@ if __name__ == '__main__':
     if validate_config(config):
         sys.exit(1)
 
-    # Create a connection to the database
-    postgresql_connection = create_connection(config)
+    # Create the pool of connections to the database
+    postgresql_connection = create_connection_pool(config)
     if postgresql_connection is None:
         logger.critical("Could not be possible to connect to PostgreSQL. Due to this error, the program will exit")
         sys.exit(1)
@@ -382,17 +507,50 @@ if __name__ == '__main__':
         sys.exit(1)
 
     config = additional_variables_setup(config)
+    config.llm_completion_cache_bypass = args.no_llm_cache
+    config.vector_search_filters = {'filenames': args.filter_file, 'file_ids': args.filter_file_id, 'batches': args.filter_batch}
+    if not any(config.vector_search_filters.values()):
+        config.vector_search_filters = None
+    create_client(config)
 
     if args.build_rag:
         errnum, errmsg=graph_from_pdf_directory(config, postgresql_connection, graph, args.ontology)
         if "000000" not in errnum:
             logger.critical("Due to this error, the program will exit")
             postgresql_connection.close()
+            close_client()
+            close_caches()
             sys.exit(1)
 
     if args.update_table:
         create_insert_prompt_tables(config, postgresql_connection)
 
+    if args.vector_index == 'rebuild':
+        errnum, errmsg=create_vector_index(postgresql_connection, config)
+        if "000000" not in errnum:
+            logger.critical("Due to this error, the program will exit")
+            postgresql_connection.close()
+            close_client()
+            close_caches()
+            sys.exit(1)
+
+    if args.vector_index:
+        df=vector_index_info(postgresql_connection)
+        if df is None or len(df)==0:
+            print("Table Vectors has no indexes")
+        else:
+            print(df.to_string(index=False))
+
+    if args.graph_index:
+        node_labels, edge_labels=return_graph_labels(graph)
+        report=ensure_graph_indexes(graph, node_labels, create=args.graph_index == 'create')
+        if report is None:
+            print("Indexes of the knowledge graph couldn't be retrieved")
+        else:
+            for kind, label, property, status in report:
+                target=f":{label}({property})" if property else f":{label}"
+                print(f"{status:<8} {kind:<7} {target}")
+
     if args.vector_chat:
         chat_loop_vector_questions(config, postgresql_connection)
 
@@ -405,3 +563,5 @@ if __name__ == '__main__':
         chat_loop(config, postgresql_connection, graph, rdf_additional_data)
 
     postgresql_connection.close()
+    close_client()
+    close_caches()
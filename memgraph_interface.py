@@ -27,19 +27,112 @@ RETURN mergedChunk
 """
 
 # ERRORS [201,250]
-def initialize_graph_with_chunk(graph):
+def initialize_graph_with_chunk(graph, node_labels=()):
 	"""
-	Initializes KG in Memgraph. Error interval: [201,250]
+	Initializes KG in Memgraph, and creates the indexes and constraints it's queried with. Error interval: [201,250]
 
 	Params:
 		langchain_community.graphs.memgraph_graph.MemgraphGraph (graph): Memgraph knowledge graph
+		list (node_labels): Labels of the nodes extracted by LLM, e.g. ontology classes
 
 	Returns:
 		Message Code, and Message Text.
 	"""
 	truncate_graph(graph)
+	if ensure_graph_indexes(graph, node_labels) is None:
+		return handle_logs(201, "Indexes of the knowledge graph couldn't be created. Queries will scan every node", logger.ERROR)
 	return handle_logs(logging_level=logger.DEBUG)
 
+# Bookkeeping nodes, with the property they are merged on. It's unique, so it also gets a uniqueness constraint.
+# Extracted nodes are merged on name, which is only unique per label. While their chunk is processed, they also have
+# the temporary label OnProgress, and are looked up by progressId
+BOOKKEEPING_KEYS={'Chunk': 'chunkId', 'PdfFile': 'fileId'}
+
+def graph_index_specs(node_labels):
+	"""
+	Indexes and constraints the KG needs
+
+	Params:
+		list (node_labels): Labels of the nodes extracted by LLM
+
+	Returns:
+		list (specs): (kind, label, property) tuples, where kind is 'index' or 'unique'. Label indexes have no property
+	"""
+	specs=[]
+	for label, key in BOOKKEEPING_KEYS.items():
+		specs.append(('index', label, key))
+		specs.append(('unique', label, key))
+	specs.append(('index', 'OnProgress', None))
+	specs.append(('index', 'OnProgress', 'progressId'))
+	for label in node_labels:
+		if label and label not in BOOKKEEPING_KEYS and label != 'OnProgress':
+			specs.append(('index', label, 'name'))
+	return list(dict.fromkeys(specs))
+
+def existing_graph_indexes(graph):
+	"""
+	Params:
+		langchain_community.graphs.memgraph_graph.MemgraphGraph (graph): Memgraph knowledge graph
+
+	Returns:
+		set: (kind, label, property) of the label and label-property indexes, and uniqueness constraints of the KG
+	"""
+	existing=set()
+	for row in graph.query("SHOW INDEX INFO;"):
+		property=row.get('property')
+		if isinstance(property, list):
+			property=property[0] if len(property)==1 else None
+		if row.get('index type')=='label':
+			existing.add(('index', row['label'], None))
+		elif row.get('index type')=='label+property' and property:
+			existing.add(('index', row['label'], property))
+	for row in graph.query("SHOW CONSTRAINT INFO;"):
+		properties=row.get('properties')
+		if isinstance(properties, list):
+			properties=properties[0] if len(properties)==1 else None
+		if row.get('constraint type')=='unique' and properties:
+			existing.add(('unique', row['label'], properties))
+	return existing
+
+def ensure_graph_indexes(graph, node_labels=(), create=True):
+	"""
+	Compares the indexes and constraints the KG needs with the existing ones, and creates the missing ones
+
+	Params:
+		langchain_community.graphs.memgraph_graph.MemgraphGraph (graph): Memgraph knowledge graph
+		list (node_labels): Labels of the nodes extracted by LLM
+		bool (create): If False, missing indexes are only reported
+
+	Returns:
+		list (report): (kind, label, property, status) tuples, where status is 'exists', 'created' or 'missing'.
+		None if the indexes couldn't be retrieved
+	"""
+	try:
+		existing=existing_graph_indexes(graph)
+	except Exception as ex:
+		logger.error(f"Indexes of the knowledge graph couldn't be retrieved: {ex}")
+		return None
+	report=[]
+	for kind, label, property in graph_index_specs(node_labels):
+		status='exists'
+		if (kind, label, property) not in existing:
+			status='missing'
+			if create:
+				if kind=='unique':
+					query=f"CREATE CONSTRAINT ON (n:{label}) ASSERT n.{property} IS UNIQUE;"
+				elif property is None:
+					query=f"CREATE INDEX ON :{label};"
+				else:
+					query=f"CREATE INDEX ON :{label}({property});"
+				try:
+					graph.query(query)
+					status='created'
+					logger.debug(f"Created {kind} on :{label}({property or ''})")
+				except Exception as ex:
+					logger.error(f"Error during execution of '{query}': {ex}")
+		report.append((kind, label, property, status))
+	return report
+
 def merge_new_graph_chunk_node(graph, chunk):
 	"""
 	Creates/Merge new KG node in Memgraph
@@ -132,35 +225,34 @@ def hierarchy2nodeLabels(label, local2uri, hierarchy):
 	return None
 
 
-def add_superclasses(graph, node, label, local2uri, hierarchy):
+def insert_knowledge_graph_nodes_relations(graph, conn, chunk, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy):
 	"""
-	Creates/Merges a new node in KG
+	Insert new node from LLM response. To insert several LLM responses, KnowledgeGraphBatch saves round trips
 
 	Params:
 		langchain_community.graphs.memgraph_graph.MemgraphGraph (graph): Memgraph knowledge graph
-		string (node): Value of 'name' property in new node
-		string (label): Name of node label
+		dict (conn): LLM-detected relation between 2 nodes
+		dict (chunk): Chunk with metadata
+		rdflib.Graph (rdf_graph): Ontology graph
+		list (rdf_nodes): List of possible nodes
+		list (rdf_edges): List of possible edges
 		dict (local2uri): Relation between local name and URI
 		dict (hierarchy): Dictionary that lists, per ontology class, the set of superclass related to that class
+		dict (rel_hierarchy): Dictionary that lists, per ontology relation, the set of superclass related to that relation
 	"""
-	superclasses=hierarchy2nodeLabels(label, local2uri, hierarchy)
-	if superclasses is not None:
-		superclass_query=f"""
-		MATCH (m:{label} {{name: '{node}'}})
-		SET m:{superclasses}
-		RETURN labels(m);
-		"""
-		logger.info(f"Adding superclasses with query:\n{superclass_query}")
-		graph.query(superclass_query)
+	batch=KnowledgeGraphBatch(graph, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy)
+	batch.add(conn)
+	batch.flush()
 
-def insert_knowledge_graph_nodes_relations(graph, conn, chunk, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy):
+
+class KnowledgeGraphBatch:
 	"""
-	Insert new node from LLM response
+	Collects the nodes and relations of validated LLM triples, and writes them with a few UNWIND statements, all
+	in a single transaction. Rows are split in layers (see add_node), written in order; each layer has one
+	statement per node label, followed by one statement per relation type
 
 	Params:
 		langchain_community.graphs.memgraph_graph.MemgraphGraph (graph): Memgraph knowledge graph
-		dict (conn): LLM-detected relation between 2 nodes
-		dict (chunk): Chunk with metadata
 		rdflib.Graph (rdf_graph): Ontology graph
 		list (rdf_nodes): List of possible nodes
 		list (rdf_edges): List of possible edges
@@ -168,97 +260,174 @@ def insert_knowledge_graph_nodes_relations(graph, conn, chunk, rdf_graph, rdf_no
 		dict (hierarchy): Dictionary that lists, per ontology class, the set of superclass related to that class
 		dict (rel_hierarchy): Dictionary that lists, per ontology relation, the set of superclass related to that relation
 	"""
-	for k in conn.keys():
-		conn[k]=remove_special_chars_in_llm_output(conn[k])
-	head=conn['head']
-	tail=conn['tail']
-	head_type=validate_graph_element(clean_node_metadata(conn['head_type']), rdf_nodes )
-	relation=validate_graph_element(clean_node_metadata(conn['relation']), rdf_edges )
-	tail_type=validate_graph_element(clean_node_metadata(conn['tail_type']), rdf_nodes)
-
-	if head and head_type:
+	def __init__(self, graph, rdf_graph, rdf_nodes, rdf_edges, local2uri, hierarchy, rel_hierarchy):
+		self.graph=graph
+		self.rdf_graph=rdf_graph
+		self.rdf_nodes=rdf_nodes
+		self.rdf_edges=rdf_edges
+		self.local2uri=local2uri
+		self.hierarchy=hierarchy
+		self.rel_hierarchy=rel_hierarchy
+		# Rows keyed by (layer, node label), and by (layer, head label, relation type, tail label). Dicts keep
+		# insertion order, so the first triple that mentions a node still sets its progressId
+		self.nodes={}
+		self.relations={}
+		# (layer, label) of the last row queued for each node name
+		self.last_node={}
+
+	def __len__(self):
+		return sum(len(rows) for rows in self.nodes.values()) + sum(len(rows) for rows in self.relations.values())
+
+	def add_node(self, name, label, progress_id):
+		"""
+		Queues a node MERGE. Only rows sharing a name can affect each other: a node merged with a subclass label
+		gets its superclass labels, so a later MERGE with the superclass label matches it instead of creating
+		another node. A name queued again with a different label therefore goes to the next layer, and layers
+		are written in order, which keeps the outcome of merging triple by triple
+
+		Params:
+			string (name): Value of 'name' property
+			string (label): Name of node label
+			string (progress_id): Temporary node ID, set if the node is created
+		"""
+		layer, last_label = self.last_node.get(name, (0, label))
+		if last_label != label:
+			layer+=1
+		self.last_node[name]=(layer, label)
+		self.nodes.setdefault((layer, label), []).append({'name': name, 'progressId': progress_id, 'originalType': label})
 
-		merge_node_query = f"""
-		MERGE (m:{head_type} {{name: '{head}'}})
-			ON CREATE SET 
-			m.onProgress = 'Y',
-			m.progressId = '{conn['prefix_id']+'A'}',
-			m.originalType = '{head_type}'
-		RETURN m;
+	def add_relation(self, head, head_type, relation, tail, tail_type):
 		"""
-		graph.query(merge_node_query)
-		
-		if rdf_graph is not None:
-			add_superclasses(graph, head, head_type, local2uri, hierarchy)
+		Queues a relation MERGE in the layer of its nodes. Later rows of these names with another label go to a
+		later layer, so the relation only matches the nodes that existed when its triple was read
+		"""
+		layer=max(self.last_node.get(head, (0, head_type))[0], self.last_node.get(tail, (0, tail_type))[0])
+		for name, label in [(head, head_type), (tail, tail_type)]:
+			self.last_node[name]=(layer, self.last_node.get(name, (layer, label))[1])
+		self.relations.setdefault((layer, head_type, relation, tail_type), []).append({'head': head, 'tail': tail})
 
-	if tail and tail_type:
+	def add(self, conn):
+		"""
+		Validates an LLM-detected triple against the ontology, and queues its nodes and relation
 
-		merge_node_query = f"""
-		MERGE (n:{tail_type} {{name: '{tail}'}})
-			ON CREATE SET 
-			n.onProgress = 'Y',
-			n.progressId = '{conn['prefix_id']+'B'}',
-			n.originalType = '{tail_type}'
-		RETURN n;
+		Params:
+			dict (conn): LLM-detected relation between 2 nodes
 		"""
-		graph.query(merge_node_query)
-
-		if rdf_graph is not None:
-			add_superclasses(graph, tail, tail_type, local2uri, hierarchy)
-
-
-	if head and tail and head_type and relation and tail_type:
-
-		shouldIncludeRelation=True
-		if local2uri:
-			if head_type not in local2uri.keys() or tail_type not in local2uri.keys() or relation not in local2uri.keys():
-				logger.error(f"""Couldn't retrieve LLM detected labels and RDF labels.
-									head_type: {head_type}, tail_type: {tail_type}, relation: {relation}
-									RDF labels:{local2uri.keys()}
-								""")
-			else:
-				shouldIncludeRelation=validate_relation(rdf_graph, local2uri[head_type], local2uri[relation], local2uri[tail_type])
-				if not shouldIncludeRelation:
-					shouldIncludeRelation=validate_relation(rdf_graph, local2uri[tail_type], local2uri[relation], local2uri[head_type])
-					if shouldIncludeRelation:
-						war_msg=f"""LLM created a relation with an inverse direction. 
-						LLM Detected Relation:
-						<<head: {head}, head_type: {head_type}, relation: {relation}, tail: {tail}, tail_type: {tail_type}>>
-						Changing to:
-						<<head: {tail}, head_type: {tail_type}, relation: {relation}, tail: {head}, tail_type: {head_type}>>
-						
-						Manually adjusting..."""
-						logger.warning(war_msg)
-						aux=head_type
-						head_type=tail_type
-						tail_type=aux
-						aux=head
-						head=tail
-						tail=aux
-					else:
-						info_msg = f""" Relation '{relation}' cannot exist between classes '{head_type}' and '{tail_type}'
-						Skipping relation..."""
-						logger.info(info_msg)
-
-		if shouldIncludeRelation:		
-			merge_node_query = f"""
-			MATCH (m:{head_type} {{name: '{head}'}}), (n:{tail_type} {{name: '{tail}'}})
-			MERGE (m)-[r:{relation}]->(n)
-			RETURN m;
-			"""
-			graph.query(merge_node_query)
+		# Names are sent as query parameters, so they're not escaped like the labels
+		head=str(conn['head']).strip().replace("&","and")
+		tail=str(conn['tail']).strip().replace("&","and")
+		head_type=validate_graph_element(clean_node_metadata(remove_special_chars_in_llm_output(conn['head_type'])), self.rdf_nodes )
+		relation=validate_graph_element(clean_node_metadata(remove_special_chars_in_llm_output(conn['relation'])), self.rdf_edges )
+		tail_type=validate_graph_element(clean_node_metadata(remove_special_chars_in_llm_output(conn['tail_type'])), self.rdf_nodes)
+
+		if head and head_type:
+			self.add_node(head, head_type, conn['prefix_id']+'A')
+
+		if tail and tail_type:
+			self.add_node(tail, tail_type, conn['prefix_id']+'B')
+
+		if head and tail and head_type and relation and tail_type:
+
+			shouldIncludeRelation=True
+			local2uri=self.local2uri
+			if local2uri:
+				if head_type not in local2uri.keys() or tail_type not in local2uri.keys() or relation not in local2uri.keys():
+					logger.error(f"""Couldn't retrieve LLM detected labels and RDF labels.
+										head_type: {head_type}, tail_type: {tail_type}, relation: {relation}
+										RDF labels:{local2uri.keys()}
+									""")
+				else:
+					shouldIncludeRelation=validate_relation(self.rdf_graph, local2uri[head_type], local2uri[relation], local2uri[tail_type])
+					if not shouldIncludeRelation:
+						shouldIncludeRelation=validate_relation(self.rdf_graph, local2uri[tail_type], local2uri[relation], local2uri[head_type])
+						if shouldIncludeRelation:
+							war_msg=f"""LLM created a relation with an inverse direction. 
+							LLM Detected Relation:
+							<<head: {head}, head_type: {head_type}, relation: {relation}, tail: {tail}, tail_type: {tail_type}>>
+							Changing to:
+							<<head: {tail}, head_type: {tail_type}, relation: {relation}, tail: {head}, tail_type: {head_type}>>
+							
+							Manually adjusting..."""
+							logger.warning(war_msg)
+							head_type, tail_type = tail_type, head_type
+							head, tail = tail, head
+						else:
+							info_msg = f""" Relation '{relation}' cannot exist between classes '{head_type}' and '{tail_type}'
+							Skipping relation..."""
+							logger.info(info_msg)
+
+			if shouldIncludeRelation:
+				self.add_relation(head, head_type, relation, tail, tail_type)
+				if self.rdf_graph is not None:
+					edge_hierarchy = hierarchy2nodeLabels(relation, local2uri, self.rel_hierarchy)
+					if edge_hierarchy is not None:
+						for edgeSuperClass in edge_hierarchy.split(':'):
+							self.add_relation(head, head_type, edgeSuperClass, tail, tail_type)
+
+	def statements(self):
+		"""
+		Returns:
+			list (statements): (query, parameters) tuples writing the queued nodes and relations, layer by layer
+		"""
+		statements=[]
+		layers=sorted({key[0] for key in self.nodes} | {key[0] for key in self.relations})
+		for current_layer in layers:
+			for (layer, label), rows in self.nodes.items():
+				if layer != current_layer:
+					continue
+				superclasses=None
+				if self.rdf_graph is not None:
+					superclasses=hierarchy2nodeLabels(label, self.local2uri, self.hierarchy)
+				query = f"""
+				UNWIND $rows AS row
+				MERGE (m:{label} {{name: row.name}})
+					ON CREATE SET 
+					m:OnProgress,
+					m.onProgress = 'Y',
+					m.progressId = row.progressId,
+					m.originalType = row.originalType
+				"""
+				if superclasses is not None:
+					query += f"SET m:{superclasses}\n"
+				statements.append((query, {'rows': rows}))
+			for (layer, head_type, relation, tail_type), rows in self.relations.items():
+				if layer != current_layer:
+					continue
+				query = f"""
+				UNWIND $rows AS row
+				MATCH (m:{head_type} {{name: row.head}}), (n:{tail_type} {{name: row.tail}})
+				MERGE (m)-[r:{relation}]->(n)
+				"""
+				statements.append((query, {'rows': rows}))
+		return statements
 
-			if rdf_graph is not None:
-				edge_hierarchy = hierarchy2nodeLabels(relation, local2uri, rel_hierarchy)
-				if edge_hierarchy is not None:
-					edgeSuperClasses=edge_hierarchy.split(':')
-					for edgeSuperClass in edgeSuperClasses:
-						merge_node_query = f"""
-						MATCH (m:{head_type} {{name: '{head}'}}), (n:{tail_type} {{name: '{tail}'}})
-						MERGE (m)-[r:{edgeSuperClass}]->(n)
-						RETURN m;
-						"""
-						graph.query(merge_node_query)
+	def flush(self):
+		"""
+		Writes the queued nodes and relations in a single transaction, and empties the batch. Graphs without a
+		Bolt driver fall back to one graph.query per statement
+		"""
+		statements=self.statements()
+		self.nodes={}
+		self.relations={}
+		self.last_node={}
+		if not statements:
+			return
+		logger.debug(f"Writing knowledge graph batch with {len(statements)} statements")
+		# MemgraphGraph doesn't expose transactions, so its (private) Bolt driver is used when it has one.
+		# A failed transaction is rolled back as a whole, so nothing is written twice by the fallback
+		driver=getattr(self.graph, '_driver', None)
+		if driver is not None:
+			try:
+				with driver.session(database=getattr(self.graph, '_database', None)) as session:
+					with session.begin_transaction() as tx:
+						for query, params in statements:
+							tx.run(query, params).consume()
+						tx.commit()
+				return
+			except Exception as ex:
+				logger.warning(f"Knowledge graph batch couldn't be written in a transaction ({ex}). Writing it statement by statement")
+		for query, params in statements:
+			self.graph.query(query, params=params)
 
 
 def return_onProcess_nodes(graph):
@@ -272,7 +441,7 @@ def return_onProcess_nodes(graph):
 		list: Nodes that relate to current analyzed text chunk
 	"""
 	query="""
-	MATCH (n)  
+	MATCH (n:OnProgress)  
 	WHERE n.onProgress IS NOT NULL
 	RETURN n.name AS nodes, n.progressId AS progressId, n.originalType AS originalType;
 	"""
@@ -300,16 +469,16 @@ def remove_onProcess_status(graph):
 	for row in results:
 		counter+=1
 		query=f"""
-		MATCH (n)
+		MATCH (n:OnProgress)
 		WHERE n.progressId = '{row['progressId']}'
 		SET n.id = '{counter:09x}'
 		RETURN n
 		"""
 		graph.query(query)
 	query="""
-	MATCH (n)
-	WHERE n.onProgress IS NOT NULL
+	MATCH (n:OnProgress)
 	SET n.onProgress = NULL, n.progressId=NULL, n.persistent=NULL, n.originalType=NULL
+	REMOVE n:OnProgress
 	RETURN n;
 	"""
 	graph.query(query)
@@ -326,9 +495,9 @@ def recover_label_list_of_subgroup(graph, progressId ):
 		list (result): Label nodes
 	"""
 	query=f"""
-	MATCH (n)
+	MATCH (n:OnProgress)
 	WHERE n.progressId = '{progressId}'
-	RETURN labels(n) as nodeLabels
+	RETURN [label IN labels(n) WHERE label <> 'OnProgress'] as nodeLabels
 	"""
 	logger.debug(f"Querying Cypher: {query}")
 	result = graph.query(query)
@@ -359,7 +528,7 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 			head_progressId=similar_groups[originalTypeGroup][0]
 			lats_known_id=head_progressId
 			query=f"""
-			MATCH (n {{progressId: '{head_progressId}'}})
+			MATCH (n:OnProgress {{progressId: '{head_progressId}'}})
 			SET n.persistent = 'Y' {labelSet}
 			RETURN n.name AS name
 			"""
@@ -369,8 +538,8 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 				logger.debug("Getting data from next similar node")
 				tail_progressId = similar_groups[originalTypeGroup][i]
 				query=f"""
-				MATCH (old {{progressId: '{tail_progressId}'}}),
-				      (new {{progressId: '{head_progressId}'}})
+				MATCH (old:OnProgress {{progressId: '{tail_progressId}'}}),
+				      (new:OnProgress {{progressId: '{head_progressId}'}})
 
 				// Merge properties (overwritting head data)
 				SET new += old
@@ -384,7 +553,7 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 				alias.append(tail_name)
 				# Combining Relations
 				query=f"""
-				MATCH (old {{progressId: '{tail_progressId}'}})-[r]-(o)
+				MATCH (old:OnProgress {{progressId: '{tail_progressId}'}})-[r]-(o)
 				RETURN type(r) AS target_relations_type, startNode(r) AS starting_node, endNode(r) AS ending_node;
 				"""
 				logger.debug(f"Querying Cypher: {query}")
@@ -395,7 +564,7 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 					if row['starting_node']['properties']['progressId'] != tail_progressId:
 						senderMerge = f"(new)<-[:{row['target_relations_type']}]-(t);"
 					query=f"""
-					MATCH (new {{progressId: '{tail_progressId}'}}), (t {{progressId: '{row['ending_node']['progressId']}'}})
+					MATCH (new:OnProgress {{progressId: '{tail_progressId}'}}), (t {{progressId: '{row['ending_node']['progressId']}'}})
 					MERGE {senderMerge}
 					"""
 					logger.debug(f"Querying Cypher: {query}")
@@ -403,7 +572,7 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 
 				# Deleting the <old> node
 				query=f"""
-				MATCH (n {{progressId: '{tail_progressId}'}})
+				MATCH (n:OnProgress {{progressId: '{tail_progressId}'}})
 				WHERE n.persistent IS NULL
 				DETACH DELETE n;
 				"""
@@ -412,7 +581,7 @@ def combine_similar_group_nodes(graph, rdf_graph, local2uri, hierarchy, similar_
 				lats_known_id=tail_progressId
 			if len(alias)>1: 
 				query=f"""
-				MATCH (n {{progressId: '{tail_progressId}'}})
+				MATCH (n:OnProgress {{progressId: '{tail_progressId}'}})
 				SET n.alias='{';'.join(alias[:-1])}'
 				"""
 				logger.debug(f"Querying Cypher: {query}")
@@ -436,7 +605,7 @@ def create_new_relations(graph, same_relations):
 				leftNode=tupleRel[0]
 				rightNode=tupleRel[1]
 				query = f"""
-				MATCH (m {{progressId: '{leftNode}'}}), (n {{progressId: '{rightNode}'}})
+				MATCH (m:OnProgress {{progressId: '{leftNode}'}}), (n:OnProgress {{progressId: '{rightNode}'}})
 				MERGE (m)-[r:{relation}]->(n);
 				"""
 				graph.query(query)
@@ -461,7 +630,7 @@ def counts_connections_from_a_to_b(graph, headId, relationType, tailId):
 	"""
 	try:
 		query=f"""
-		MATCH (n {{progressId:'{headId}'}}) -[r:{relationType}]->(m {{progressId:'{tailId}'}})
+		MATCH (n:OnProgress {{progressId:'{headId}'}}) -[r:{relationType}]->(m:OnProgress {{progressId:'{tailId}'}})
 		RETURN COUNT(r) AS numberOfRelations
 		"""
 		numberOfRelations=graph.query(query)
@@ -500,8 +669,7 @@ def linkActiveNodesToFile(graph,  fileId):
 	"""
 	try:
 		query=f"""
-		MATCH (m), (n:PdfFile {{fileId: '{fileId}'}})
-		WHERE m.onProgress IS NOT NULL
+		MATCH (m:OnProgress), (n:PdfFile {{fileId: '{fileId}'}})
 		MERGE (m)-[r:DefinedInFile]->(n)
 		"""
 		graph.query(query)
@@ -0,0 +1,378 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from base_logger import logger, load_config
+
+
+def local_parser():
+	"""
+	Program display
+	"""
+	parser = argparse.ArgumentParser(
+		description='Local stand-in for the LM Studio /v1/embeddings and /v1/chat/completions endpoints, for load testing and benchmarks'
+		)
+	parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+	parser.add_argument("--port", type=int, default=1234, help="Port to listen on")
+	parser.add_argument("--dim", type=int, default=None, help="Embedding length. Defaults to llm_embedding_vector_len in config.yaml")
+	parser.add_argument("--embedding-latency", default="constant:5", help="Latency of embedding requests, as <distribution>:<ms>[:<spread ms>]. Distributions: constant, uniform, normal, exponential")
+	parser.add_argument("--embedding-latency-per-input", type=float, default=1.0, help="Additional ms per embedded input")
+	parser.add_argument("--chat-latency", default="normal:300:100", help="Latency of chat requests, as <distribution>:<ms>[:<spread ms>]")
+	parser.add_argument("--token-latency", type=float, default=5.0, help="ms between streamed tokens")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+	parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of requests answered with a body that is not valid JSON")
+	parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of requests that stall for --stall-seconds before answering")
+	parser.add_argument("--stall-seconds", type=float, default=30.0, help="Duration of stalled requests")
+	parser.add_argument("--node-types", default="Structure,Damage,Element", help="Comma separated node labels used in scripted triples")
+	parser.add_argument("--relation-types", default="hasDamage,hasPart", help="Comma separated relation labels used in scripted triples")
+	parser.add_argument("--script", default=None, help="JSON file with a list of {\"match\": <regex>, \"reply\": <text>} checked, in order, against the last user message")
+	parser.add_argument("--seed", type=int, default=0, help="Seed of latency and error injection")
+	parser.add_argument("--benchmark", type=int, default=0, help="Instead of serving forever, start the server and send this number of requests of each kind through lmstudio.py")
+	parser.add_argument("--concurrency", type=int, default=4, help="Number of concurrent clients during --benchmark")
+	return parser
+
+
+class LatencyModel:
+	"""
+	Random latency following a distribution
+
+	Params:
+		string (spec): <distribution>:<ms>[:<spread ms>]
+		random.Random (rng): Random generator
+	"""
+	def __init__(self, spec, rng):
+		parts=spec.split(':')
+		self.distribution=parts[0].lower()
+		if self.distribution not in ['constant', 'uniform', 'normal', 'exponential']:
+			raise ValueError(f"Unknown latency distribution '{parts[0]}'")
+		self.mean=float(parts[1]) if len(parts) > 1 else 0.0
+		self.spread=float(parts[2]) if len(parts) > 2 else 0.0
+		self.rng=rng
+
+	def sample(self):
+		"""
+		Returns:
+			float: Latency in seconds
+		"""
+		if self.distribution == 'uniform':
+			ms=self.rng.uniform(self.mean - self.spread, self.mean + self.spread)
+		elif self.distribution == 'normal':
+			ms=self.rng.gauss(self.mean, self.spread)
+		elif self.distribution == 'exponential':
+			ms=self.rng.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+		else:
+			ms=self.mean
+		return max(ms, 0.0) / 1000
+
+
+def fake_embedding(text, dim):
+	"""
+	Deterministic unit-length embedding of a text
+
+	Params:
+		string (text): Text to embed
+		int (dim): Embedding length
+
+	Returns:
+		list (embedding): Embedding
+	"""
+	rng=random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+	vector=[rng.gauss(0.0, 1.0) for _ in range(dim)]
+	norm=math.sqrt(sum(v * v for v in vector)) or 1.0
+	return [v / norm for v in vector]
+
+
+class MockBehaviour:
+	"""
+	Scripted replies, latencies and injected errors of the mock server
+
+	Params:
+		argparse.Namespace (args): Command line options
+		dict (config): Configuration dictionary using values from .yaml file
+	"""
+	def __init__(self, args, config):
+		self.rng=random.Random(args.seed)
+		self.lock=threading.Lock()
+		self.dim=args.dim or getattr(config, 'llm_embedding_vector_len', 768)
+		self.embedding_latency=LatencyModel(args.embedding_latency, self.rng)
+		self.embedding_latency_per_input=args.embedding_latency_per_input / 1000
+		self.chat_latency=LatencyModel(args.chat_latency, self.rng)
+		self.token_latency=args.token_latency / 1000
+		self.error_rate=args.error_rate
+		self.malformed_rate=args.malformed_rate
+		self.stall_rate=args.stall_rate
+		self.stall_seconds=args.stall_seconds
+		self.node_types=[t.strip() for t in args.node_types.split(',') if t.strip()]
+		self.relation_types=[t.strip() for t in args.relation_types.split(',') if t.strip()]
+		self.script=[]
+		if args.script:
+			with open(args.script) as f:
+				self.script=[(re.compile(item['match'], re.DOTALL), item['reply']) for item in json.load(f)]
+
+	def roll(self):
+		"""
+		Returns:
+			string: Injected fault for the next request, one of 'error', 'malformed', 'stall' or None
+		"""
+		with self.lock:
+			value=self.rng.random()
+		for fault, rate in [('error', self.error_rate), ('malformed', self.malformed_rate), ('stall', self.stall_rate)]:
+			if value < rate:
+				return fault
+			value-=rate
+		return None
+
+	def sample(self, latency_model):
+		with self.lock:
+			return latency_model.sample()
+
+	def chat_reply(self, messages):
+		"""
+		Scripted reply to a chat request
+
+		Params:
+			list (messages): Messages of the request
+
+		Returns:
+			string: Reply
+		"""
+		system='\n'.join(m.get('content', '') for m in messages if m.get('role') == 'system')
+		user=[m.get('content', '') for m in messages if m.get('role') == 'user']
+		user=user[-1] if user else ''
+		for pattern, reply in self.script:
+			if pattern.search(user):
+				return reply
+		if 'QUESTIONS: [' in user:
+			# Yes/no question batches of interactions.ask_llm_node_similarity
+			answers={}
+			for question_id in re.findall(r'"(Q\d+):', user):
+				digest=hashlib.sha256((question_id + user).encode('utf-8')).digest()
+				answers[question_id]='yes' if digest[0] % 2 == 0 else 'no'
+			return json.dumps(answers)
+		if 'cypher' in system.lower():
+			return "MATCH (n) RETURN n.name AS name LIMIT 5"
+		if 'head_type' in system or 'head_type' in user:
+			return json.dumps(self.triples(user))
+		return f"Mock answer based on {len(user)} characters of context (réponse simulée)."
+
+	def triples(self, text):
+		"""
+		Deterministic triples built from the capitalized words of a text chunk
+
+		Params:
+			string (text): Text chunk
+
+		Returns:
+			list: Triples in the format requested by the KG extraction prompt
+		"""
+		names=[]
+		for word in re.findall(r'\b[A-Z][a-zA-Z]{3,}\b', text):
+			if word not in names:
+				names.append(word)
+		triples=[]
+		for i in range(0, len(names) - 1, 2):
+			digest=hashlib.sha256((names[i] + names[i + 1]).encode('utf-8')).digest()
+			triples.append({
+				'head': names[i],
+				'head_type': self.node_types[digest[0] % len(self.node_types)],
+				'relation': self.relation_types[digest[1] % len(self.relation_types)],
+				'tail': names[i + 1],
+				'tail_type': self.node_types[digest[2] % len(self.node_types)],
+			})
+			if len(triples) >= 10:
+				break
+		return triples
+
+
+def make_handler(behaviour):
+	"""
+	Params:
+		MockBehaviour (behaviour): Behaviour of the mock server
+
+	Returns:
+		class: Request handler of the mock server
+	"""
+	class MockLMStudioHandler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+		# Headers and body are written separately, so Nagle would delay every response
+		disable_nagle_algorithm = True
+
+		def log_message(self, format, *args):
+			logger.debug("mock_lmstudio: " + format % args)
+
+		def send_json(self, status, body):
+			# Raw UTF-8, as LM Studio sends it, so clients are tested on decoding non-ASCII text
+			payload=body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode('utf-8')
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(payload)))
+			self.end_headers()
+			self.wfile.write(payload)
+
+		def do_GET(self):
+			if self.path.rstrip('/') == '/v1/models':
+				return self.send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+			self.send_json(404, {"error": "Not found"})
+
+		def do_POST(self):
+			length=int(self.headers.get('Content-Length', 0))
+			try:
+				request=json.loads(self.rfile.read(length) or b'{}')
+			except json.JSONDecodeError:
+				return self.send_json(400, {"error": "Invalid JSON body"})
+			fault=behaviour.roll()
+			if fault == 'stall':
+				time.sleep(behaviour.stall_seconds)
+			if fault == 'error':
+				return self.send_json(500, {"error": "Injected error"})
+			if fault == 'malformed':
+				return self.send_json(200, b'{"data": [')
+			path=self.path.rstrip('/')
+			if path == '/v1/embeddings':
+				return self.embeddings(request)
+			if path == '/v1/chat/completions':
+				return self.chat(request)
+			self.send_json(404, {"error": "Not found"})
+
+		def embeddings(self, request):
+			inputs=request.get('input', '')
+			if isinstance(inputs, str):
+				inputs=[inputs]
+			time.sleep(behaviour.sample(behaviour.embedding_latency) + behaviour.embedding_latency_per_input * len(inputs))
+			self.send_json(200, {
+				"object": "list",
+				"model": request.get('model'),
+				"data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, behaviour.dim)} for i, text in enumerate(inputs)],
+			})
+
+		def chat(self, request):
+			reply=behaviour.chat_reply(request.get('messages', []))
+			time.sleep(behaviour.sample(behaviour.chat_latency))
+			if not request.get('stream'):
+				return self.send_json(200, {
+					"object": "chat.completion",
+					"model": request.get('model'),
+					"choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+				})
+			self.send_response(200)
+			self.send_header("Content-Type", "text/event-stream")
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			for token in re.findall(r'\S+\s*', reply):
+				event={"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": token}}]}
+				self.write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+				time.sleep(behaviour.token_latency)
+			self.write_chunk(b"data: [DONE]\n\n")
+			self.write_chunk(b"")
+
+		def write_chunk(self, data):
+			self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+			self.wfile.flush()
+
+	return MockLMStudioHandler
+
+
+def create_server(args, config):
+	"""
+	Params:
+		argparse.Namespace (args): Command line options
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		http.server.ThreadingHTTPServer (server): Mock server, not started yet
+	"""
+	server=ThreadingHTTPServer((args.host, args.port), make_handler(MockBehaviour(args, config)))
+	server.daemon_threads=True
+	return server
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	values=sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_benchmark(args, config):
+	"""
+	Sends requests to a mock server through lmstudio.py and prints throughput and latency per kind of request
+
+	Params:
+		argparse.Namespace (args): Command line options
+		dict (config): Configuration dictionary using values from .yaml file
+	"""
+	import lmstudio
+
+	server=create_server(args, config)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	base_url=f"http://{args.host}:{server.server_address[1]}/v1"
+	bench_config=Namespace(**vars(config))
+	bench_config.llm_embedding_url=base_url + "/embeddings"
+	bench_config.llm_chat_url=base_url + "/chat/completions"
+	bench_config.llm_pool_size=max(args.concurrency, getattr(config, 'llm_pool_size', 10))
+	bench_config.embedding_cache_path=None
+	bench_config.llm_completion_cache_path=None
+	lmstudio.create_client(bench_config)
+	chunks=[f"Report {i}: the Bridge Pier shows a Crack near the Bearing of Span {i % 7}" for i in range(args.benchmark)]
+	messages=lambda chunk: [{"role": "system", "content": "Extract triples with head, head_type, relation, tail, tail_type"}, {"role": "user", "content": chunk}]
+
+	def timed(function, *function_args):
+		start=time.perf_counter()
+		result=function(*function_args)
+		return time.perf_counter() - start, result
+
+	scenarios=[
+		("embedding (one per request)", lambda chunk: lmstudio.get_embedding(bench_config, chunk), chunks),
+		("chat completion", lambda chunk: lmstudio.get_chat_completion(bench_config, messages(chunk)), chunks),
+		("streamed chat completion", lambda chunk: list(lmstudio.stream_chat_completion(bench_config, messages(chunk))), chunks),
+	]
+	try:
+		start=time.perf_counter()
+		embeddings=lmstudio.get_embeddings(bench_config, chunks)
+		elapsed=time.perf_counter() - start
+		failures=sum(1 for e in embeddings if e is None)
+		print(f"{'embedding (batched)':<30} {len(chunks)/elapsed:10.1f} items/s  failures: {failures}")
+		# Non-ASCII answers must come out the same whether they're streamed or not
+		check=[{"role": "system", "content": "Answer the question"}, {"role": "user", "content": "Décris l'état de la pile"}]
+		reply=lmstudio.get_chat_completion(bench_config, check)
+		streamed=''.join(lmstudio.stream_chat_completion(bench_config, check))
+		print(f"{'streamed UTF-8 answer':<30} {'matches' if reply and streamed == reply else f'MISMATCH: {streamed!r} != {reply!r}'}")
+		for name, function, items in scenarios:
+			with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+				start=time.perf_counter()
+				results=list(executor.map(lambda item: timed(function, item), items))
+				elapsed=time.perf_counter() - start
+			latencies=[latency for latency, _ in results]
+			failures=sum(1 for _, result in results if result is None or len(result) == 0)
+			print(f"{name:<30} {len(items)/elapsed:10.1f} req/s  p50: {percentile(latencies, 0.5)*1000:.1f}ms  p95: {percentile(latencies, 0.95)*1000:.1f}ms  failures: {failures}")
+	finally:
+		lmstudio.close_client()
+		server.shutdown()
+
+
+if __name__ == '__main__':
+	args = local_parser().parse_args()
+	config = load_config() or Namespace()
+	if args.benchmark > 0:
+		if args.port == 1234:
+			# Benchmarks don't need a fixed port
+			args.port=0
+		run_benchmark(args, config)
+		sys.exit(0)
+	server=create_server(args, config)
+	print(f"Mock LM Studio listening on http://{args.host}:{server.server_address[1]}/v1 (Ctrl+C to stop)")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
@@ -1,11 +1,20 @@
 from base_logger import logger
 import psycopg2
 from psycopg2 import OperationalError
-from psycopg2.extensions import adapt
+from psycopg2.extensions import adapt, encodings, connection as Psycopg2Connection
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
 import pandas as pd
+import numpy as np
+import struct
+import threading
+import itertools
+from io import BytesIO
+from collections import namedtuple
+from contextlib import contextmanager
 
-from tools import cleanWords, handle_logs
-from lmstudio import get_embedding
+from tools import handle_logs
 from re import sub
 
 def create_connection(config):
@@ -20,10 +29,227 @@ def create_connection(config):
 			port=config.db_port,
 		)
 		logger.info("Connection to PostgreSQL DB successful")
+		register_vector_type(connection, log_failure=False)
+		configure_vector_search(connection, config)
 	except OperationalError as e:
 		logger.critical(f"The error '{e}' occurred")
 	return connection
 
+class PooledConnection(Psycopg2Connection):
+	"""
+	Connection handed out by ConnectionPool. Keeps track of the session setup already done on it
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.vector_registered=False
+		self.session_configured=False
+		# Names of the PREPARED_STATEMENTS already prepared in this session
+		self.prepared=set()
+
+
+class ConnectionPool:
+	"""
+	Thread-safe pool of PostgreSQL connections. Connections are checked out with getconn (or the connection
+	context manager) and given back with putconn. When every connection is in use, getconn waits for one
+	to be returned instead of failing
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+	"""
+	def __init__(self, config):
+		self.config=config
+		# Concurrent KG extraction must not wait on a free connection
+		self.maxconn=max(getattr(config, 'db_pool_size', 10), getattr(config, 'kg_extraction_workers', 1))
+		self.timeout=getattr(config, 'db_pool_timeout', None)
+		self._pool=ThreadedConnectionPool(
+			min(getattr(config, 'db_pool_min_size', 1), self.maxconn), self.maxconn,
+			connection_factory=PooledConnection,
+			database=config.db_name,
+			user=config.db_user,
+			password=config.db_password,
+			host=config.db_host,
+			port=config.db_port,
+		)
+		self._slots=threading.BoundedSemaphore(self.maxconn)
+		self.search_warning_logged=False
+
+	def getconn(self):
+		"""
+		Returns:
+			PooledConnection (connection): Connection ready to use. It must be given back with putconn
+		"""
+		if not self._slots.acquire(timeout=self.timeout):
+			raise PoolError(f"No PostgreSQL connection was returned to the pool within {self.timeout}s")
+		try:
+			connection=self._pool.getconn()
+			self.setup(connection)
+		except Exception:
+			self._slots.release()
+			raise
+		return connection
+
+	def setup(self, connection):
+		"""
+		Session setup of a pooled connection. The vector adapter is retried on every checkout until the
+		vector extension exists, since it's created by initialize_vector_table
+
+		Params:
+			PooledConnection (connection): Database connnection
+		"""
+		if not connection.vector_registered:
+			connection.vector_registered=register_vector_type(connection, log_failure=False)
+		if not connection.session_configured:
+			# Retried on the next checkout, but only the first failure of the pool is logged
+			connection.session_configured=configure_vector_search(connection, self.config, log_failure=not self.search_warning_logged)
+			if not connection.session_configured:
+				self.search_warning_logged=True
+
+	def putconn(self, connection):
+		"""
+		Gives a connection back to the pool. Open transactions are rolled back, and broken connections are discarded
+
+		Params:
+			PooledConnection (connection): Connection returned by getconn
+		"""
+		try:
+			self._pool.putconn(connection, close=bool(connection.closed))
+		finally:
+			self._slots.release()
+
+	@contextmanager
+	def connection(self):
+		connection=self.getconn()
+		try:
+			yield connection
+		finally:
+			self.putconn(connection)
+
+	def close(self):
+		self._pool.closeall()
+
+
+def create_connection_pool(config):
+	"""
+	Creates the pool of database connections to PostgreSQL shared by every thread
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		ConnectionPool (pool): Connection pool, or None if the database couldn't be reached
+	"""
+	pool = None
+	try:
+		pool = ConnectionPool(config)
+		with pool.connection():
+			pass
+		logger.info(f"Connection pool to PostgreSQL DB successful (up to {pool.maxconn} connections)")
+	except (OperationalError, PoolError) as e:
+		logger.critical(f"The error '{e}' occurred")
+		if pool is not None:
+			pool.close()
+		pool = None
+	return pool
+
+@contextmanager
+def connection_scope(connection):
+	"""
+	Lets helpers take either a single connection or a ConnectionPool. A pool is checked out for the
+	duration of the block, and a connection is used as is
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		psycopg2.connection: Database connnection
+	"""
+	if isinstance(connection, ConnectionPool):
+		with connection.connection() as pooled_connection:
+			yield pooled_connection
+	else:
+		yield connection
+
+def register_vector_type(connection, log_failure=True):
+	"""
+	Registers the pgvector adapter in a connection, so float32 numpy arrays are sent as vector
+	parameters. Vector columns are read back as pgvector.Vector objects (to_numpy() converts them)
+
+	Params:
+		psycopg2.connection (connection): Database connnection
+		bool (log_failure): Logs an error if the vector extension isn't available
+
+	Returns:
+		bool: True if the adapter was registered
+	"""
+	try:
+		register_vector(connection)
+		if isinstance(connection, PooledConnection):
+			connection.vector_registered=True
+		return True
+	except Exception as e:
+		# The vector extension might not exist yet; it's created by initialize_vector_table
+		connection.rollback()
+		if log_failure:
+			logger.error(f"pgvector adapter couldn't be registered: {e}")
+		return False
+
+def configure_vector_search(connection, config, log_failure=True):
+	"""
+	Sets, for the whole session, the search-time parameter of the ANN index declared in .yaml file
+
+	Params:
+		psycopg2.connection (connection): Database connnection
+		dict (config): Configuration dictionary using values from .yaml file
+		bool (log_failure): Logs a warning if a parameter couldn't be set
+
+	Returns:
+		bool: True if every parameter was set. On failure, none of them is kept
+	"""
+	index_type=getattr(config, 'vector_index_type', 'none')
+	if index_type == 'hnsw':
+		# HNSW returns at most ef_search rows, which must cover every candidate to re-rank
+		k=config.k_most_similar
+		if getattr(config, 'vector_search_mode', 'vector') == 'hybrid':
+			k=max(k, getattr(config, 'hybrid_candidates', 50))
+		query="SET hnsw.ef_search = %s;"
+		params=(max(getattr(config, 'vector_hnsw_ef_search', 40), candidate_pool(config, k)),)
+	elif index_type == 'ivfflat':
+		query="SET ivfflat.probes = %s;"
+		params=(getattr(config, 'vector_ivfflat_probes', 10),)
+	else:
+		return True
+	statements=[(query, params)]
+	# Filtered searches keep scanning the index until enough rows pass the filter (pgvector 0.8+)
+	iterative_scan=getattr(config, 'vector_iterative_scan', 'off')
+	if iterative_scan != 'off':
+		statements.append((f"SET {index_type}.iterative_scan = %s;", (iterative_scan,)))
+	cursor = connection.cursor()
+	try:
+		for query, params in statements:
+			cursor.execute(query, params)
+		connection.commit()
+		return True
+	except Exception as e:
+		connection.rollback()
+		if log_failure:
+			logger.warning(f"{index_type} search parameters couldn't be set ({e}). ANN searches use the server defaults, and might return fewer candidates than the ones to re-rank")
+		return False
+	finally:
+		cursor.close()
+
+def clean_text_for_sql(string_original:str) -> str:
+	"""
+	Applies to a text sent as a query parameter the same normalization escape_string_for_sql applies to literals
+
+	Params:
+		string (string_original): Text
+
+	Returns:
+		string: Text without characters beyond latin-1 and with collapsed whitespace
+	"""
+	string_original = sub(r'[^\x00-\xFF]', '', string_original)
+	return sub(r'\s+', ' ', string_original.replace("\x00", "").strip())
+
 def escape_string_for_sql(string_original:str, add_single_quotes:bool = False) -> str:
 	string_original = sub(r'[^\x00-\xFF]', '', string_original)
 	cleaned_string = str(adapt(string_original)).replace("\n", " ")
@@ -33,54 +259,57 @@ def escape_string_for_sql(string_original:str, add_single_quotes:bool = False) -
 	return cleaned_string
 
 
-def create_insert_prompt_tables(config, connection):
-	try:
-		if not execute_sql_file(connection, config.createTables_sql):
-			return handle_logs(504,"Due to this error, the SQL tables couldn't be updated",logger.CRITICAL)
-		_converters={'prompt_id':int,'general_prompt_id':int, 'sequence_id':int, 'lang':str, 'type': str, 'description':str, 'prompt':str, 'variables':str  }
-		df = pd.read_excel(config.prompts_xlsx, converters=_converters)
-		df.fillna('', inplace=True)
-		query = """ INSERT INTO Prompts ( 
-			prompt_id, 		general_prompt_id,	sequence_id, 	lang, 	type, 
-			description, 	prompt, 			variables )
-		VALUES 
-		"""
-		string_columns = [k for k, v in _converters.items() if v==str]
-		logger.debug(f"string_columns: {string_columns}")
-		for col in string_columns:
-			df[col]=df[col].apply(lambda x: escape_string_for_sql(x, add_single_quotes=True))
-
-		for i in range(len(df)):
-			insert_value=f""" ( {df.iloc[i]['prompt_id']}, {df.iloc[i]['general_prompt_id']}, 
-								{df.iloc[i]['sequence_id']}, {df.iloc[i]['lang']}, {df.iloc[i]['type']},
-								{df.iloc[i]['description']}, {df.iloc[i]['prompt']}, 
-								{df.iloc[i]['variables']} )"""
-			query+=insert_value+', '
-
-		query=query[:-2]+'; '
-		if execute_non_query(connection, query)<-1:
-			return handle_logs(505,"Error while inserting values in table 'Prompts'",logger.CRITICAL)
-
-		df = pd.read_excel(config.examples_xlsx, converters={'example_id':int, 'general_example_id':int, 'sequence_id':int, 'lang':str, 'prompt_id':int, 'example':str, 'variables':str })
-		df.fillna('', inplace=True)
-		query = """ INSERT INTO Examples ( 
-			example_id, 		general_example_id,	sequence_id, 	lang, 	prompt_id, 
-			example, 			variables )
-		VALUES 
-		"""
-		string_columns = [col for col in df.columns if df[col].dtype == 'object' or df[col].dtype.name == 'string']
-		for col in string_columns:
-			df[col]=df[col].apply(lambda x: escape_string_for_sql(x, add_single_quotes=True))
+# Columns of the prompt tables loaded from the xlsx files, primary key first
+PROMPT_TABLES={
+	'Prompts': ['prompt_id', 'general_prompt_id', 'sequence_id', 'lang', 'type', 'description', 'prompt', 'variables'],
+	'Examples': ['example_id', 'general_example_id', 'sequence_id', 'lang', 'prompt_id', 'example', 'variables'],
+}
 
-		for i in range(len(df)):
-			insert_value=f""" ( {df.iloc[i]['example_id']}, {df.iloc[i]['general_example_id']}, 
-								{df.iloc[i]['sequence_id']}, {df.iloc[i]['lang']}, {df.iloc[i]['prompt_id']},
-								{df.iloc[i]['example']}, {df.iloc[i]['variables']} )"""
-			query+=insert_value+', '
+def create_insert_prompt_tables(config, connection):
+	"""
+	Loads prompts.xlsx and examples.xlsx into tables Prompts and Examples. The tables are only created (createTables.sql)
+	when they don't exist yet; otherwise only new and changed rows are written, and rows no longer in the files are
+	deleted, in a single transaction. The in-process prompt store is reloaded afterwards
 
-		query=query[:-2]+'; '
-		if execute_non_query(connection, query)<-1:
-			return handle_logs(506,"Error while inserting values in table 'Examples'",logger.CRITICAL)
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+	"""
+	try:
+		if not prompt_tables_exist(connection):
+			logger.info("Creating tables 'Prompts' and 'Examples'")
+			if not execute_sql_file(connection, config.createTables_sql):
+				return handle_logs(504,"Due to this error, the SQL tables couldn't be updated",logger.CRITICAL)
+		rows={
+			'Prompts': read_prompt_rows(config.prompts_xlsx, {'prompt_id':int,'general_prompt_id':int, 'sequence_id':int, 'lang':str, 'type': str, 'description':str, 'prompt':str, 'variables':str }, PROMPT_TABLES['Prompts']),
+			'Examples': read_prompt_rows(config.examples_xlsx, {'example_id':int, 'general_example_id':int, 'sequence_id':int, 'lang':str, 'prompt_id':int, 'example':str, 'variables':str }, PROMPT_TABLES['Examples']),
+		}
+		table=None
+		# The pool is used again after the block, so the checked out connection gets its own name
+		with connection_scope(connection) as scoped_connection:
+			cursor = scoped_connection.cursor()
+			try:
+				changes={}
+				for table in PROMPT_TABLES:
+					changes[table]=prompt_table_changes(cursor, table, rows[table])
+				# Examples reference Prompts: examples are removed before their prompts, and written after them
+				table='Examples'
+				delete_prompt_rows(cursor, table, changes[table][1])
+				for table in PROMPT_TABLES:
+					upsert_prompt_rows(cursor, table, changes[table][0])
+				table='Prompts'
+				delete_prompt_rows(cursor, table, changes[table][1])
+				scoped_connection.commit()
+			except Exception as e:
+				logger.error(f"The error '{e}' occurred. Rolling back...")
+				scoped_connection.rollback()
+				return handle_logs(505,f"Error while updating table '{table}'",logger.CRITICAL)
+			finally:
+				cursor.close()
+		for table, (upserts, deletes) in changes.items():
+			logger.info(f"Table '{table}': {len(upserts)} row(s) written, {len(deletes)} row(s) deleted, {len(rows[table])-len(upserts)} unchanged")
+		if reload_prompt_store(connection) is None:
+			return handle_logs(511,"Tables 'Prompts' and 'Examples' were updated, but couldn't be loaded back",logger.CRITICAL)
 		# Uncomment for debugging
 		#prompt=select_prompt(connection, config, 5, variables={'nodeLeftName':'nodeLeftName', 'nodeRightName':'nodeRightName', 'relation':'relation', 'comment': 'comment'})
 		#print(prompt)
@@ -90,172 +319,1023 @@ def create_insert_prompt_tables(config, connection):
 
 	return handle_logs()
 
-def execute_query(connection, query, df_columns):
+def prompt_tables_exist(connection):
+	"""
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		bool: True if tables Prompts and Examples exist
+	"""
+	rows = fetch_rows(connection, "SELECT to_regclass('prompts') IS NOT NULL AND to_regclass('examples') IS NOT NULL;")
+	return bool(rows and rows[0][0])
+
+def read_prompt_rows(xlsx_file, converters, columns):
+	"""
+	Reads the rows of a prompt table from its xlsx file. Texts get the same normalization escape_string_for_sql
+	gives them, and empty cells become empty strings
+
+	Params:
+		string (xlsx_file): xlsx file
+		dict (converters): Type of each column
+		list (columns): Table columns, primary key first
+
+	Returns:
+		list (rows): Rows as tuples, in the order of columns
+	"""
+	df = pd.read_excel(xlsx_file, converters=converters)
+	df.fillna('', inplace=True)
+	return [tuple(clean_text_for_sql(str(value)) if converters[column]==str else int(value) for column, value in zip(columns, row))
+		for row in df[columns].itertuples(index=False)]
+
+def prompt_table_changes(cursor, table, rows):
+	"""
+	Compares the rows of a prompt table with the rows read from its xlsx file
+
+	Params:
+		psycopg2.cursor (cursor): Database cursor
+		string (table): 'Prompts' or 'Examples'
+		list (rows): Rows read from the xlsx file
+
+	Returns:
+		list (upserts): Rows that are new or changed
+		list (deletes): Primary keys of the rows that aren't in the xlsx file
+	"""
+	columns=PROMPT_TABLES[table]
+	# Texts (and the enum column type) are read as the xlsx loader builds them: NULL is an empty string
+	cursor.execute(f"SELECT {', '.join(column if column.endswith('_id') else f'COALESCE({column}::text, %s)' for column in columns)} FROM {table};",
+		tuple('' for column in columns if not column.endswith('_id')))
+	existing={row[0]: row for row in cursor.fetchall()}
+	keys={row[0] for row in rows}
+	upserts=[row for row in rows if existing.get(row[0])!=row]
+	deletes=[key for key in existing if key not in keys]
+	return upserts, deletes
+
+def upsert_prompt_rows(cursor, table, rows):
+	if not rows:
+		return
+	columns=PROMPT_TABLES[table]
+	updates=', '.join(f"{column} = EXCLUDED.{column}" for column in columns[1:])
+	execute_values(cursor, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s ON CONFLICT ({columns[0]}) DO UPDATE SET {updates};", rows)
+
+def delete_prompt_rows(cursor, table, keys):
+	if keys:
+		cursor.execute(f"DELETE FROM {table} WHERE {PROMPT_TABLES[table][0]} = ANY(%s);", (keys,))
+
+def execute_query(connection, query, df_columns, params=None):
 	"""Execute a query and return results as a pandas DataFrame"""
-	cursor = connection.cursor()
-	df = None
-	try:
-		cursor.execute(query)
-		df = pd.DataFrame(cursor.fetchall(), columns=df_columns)
-	except Exception as e:
-		logger.error(f"The error '{e}' occurred. Rolling back...")
-	finally:
-		cursor.close()
-	return df
+	rows = fetch_rows(connection, query, params=params)
+	if rows is None:
+		return None
+	return pd.DataFrame(rows, columns=df_columns)
+
+def fetch_rows(connection, query, columns=None, params=None):
+	"""
+	Executes a query whose result is small, and returns its rows without building a DataFrame
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		string (query): SQL query
+		list (columns): Field names. If given, rows are namedtuples with these fields
+		tuple (params): Query parameters
+
+	Returns:
+		list (rows): Rows as tuples, or namedtuples if columns is given. None if the query failed
+	"""
+	rows = None
+	with connection_scope(connection) as connection:
+		cursor = connection.cursor()
+		try:
+			cursor.execute(query, params)
+			rows = cursor.fetchall()
+		except Exception as e:
+			logger.error(f"The error '{e}' occurred. Rolling back...")
+			connection.rollback()
+		finally:
+			cursor.close()
+	if rows is not None and columns is not None:
+		Row = namedtuple('Row', columns)
+		rows = [Row._make(row) for row in rows]
+	return rows
+
+_cursor_ids=itertools.count(1)
+
+def stream_rows(connection, query, columns=None, params=None, fetch_size=None):
+	"""
+	Executes a query through a server-side (named) cursor, and yields its rows as they're fetched, db_fetch_size
+	rows per round trip, so large scans never hold the whole result in memory. The connection stays checked out
+	until the generator is exhausted or closed. A failed query is logged, rolled back and re-raised, since rows
+	may have been consumed already
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		string (query): SQL query
+		list (columns): Field names. If given, rows are namedtuples with these fields
+		tuple (params): Query parameters
+		int (fetch_size): Rows fetched per round trip. Default: config db_fetch_size of the pool, or 2000
+
+	Returns:
+		generator (rows): Rows as tuples, or namedtuples if columns is given
+	"""
+	if fetch_size is None:
+		fetch_size = getattr(getattr(connection, 'config', None), 'db_fetch_size', 2000)
+	Row = namedtuple('Row', columns) if columns is not None else None
+	with connection_scope(connection) as connection:
+		cursor = connection.cursor(name=f"stream_rows_{next(_cursor_ids)}")
+		cursor.itersize = fetch_size
+		try:
+			cursor.execute(query, params)
+			while True:
+				rows = cursor.fetchmany(fetch_size)
+				if not rows:
+					break
+				for row in rows:
+					yield row if Row is None else Row._make(row)
+		except Exception as e:
+			logger.error(f"The error '{e}' occurred. Rolling back...")
+			connection.rollback()
+			raise
+		finally:
+			if not cursor.closed and not connection.closed:
+				try:
+					cursor.close()
+				except Exception:
+					pass
 
 def initialize_vector_table(connection, config):
-	logger.debug("Initializing vector table. This should not be running every search!")
+	"""
+	Creates tables Vectors and VectorFiles. When vector_build_mode is 'incremental', existing tables are kept
+	unless their layout (embedding length, partitions) doesn't match .yaml file; otherwise both are dropped first.
+	If vector_partitions is greater than 0, Vectors is hash-partitioned by file_id
 
-	query="DROP TABLE IF EXISTS Vectors CASCADE;"
-	if execute_non_query(connection, query)<-1:
-		return handle_logs(501,"Error while dropping vector table",logger.CRITICAL)
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		Message Code, and Message Text.
+	"""
+	logger.debug("Initializing vector table. This should not be running every search!")
 
 	query="CREATE EXTENSION IF NOT EXISTS vector;"
 	if execute_non_query(connection, query)<-1:
 		return handle_logs(502,"Failure at creating vector extension",logger.CRITICAL)
+	with connection_scope(connection) as session:
+		if not register_vector_type(session):
+			return handle_logs(507,"Failure at registering pgvector adapter",logger.CRITICAL)
+
+	partitions=getattr(config, 'vector_partitions', 0)
+	incremental=getattr(config, 'vector_build_mode', 'rebuild') == 'incremental'
+	if incremental:
+		layout=vector_table_layout(connection)
+		if layout is not None:
+			expected={'dimension': config.llm_embedding_vector_len, 'has_file_id': True, 'partitions': partitions}
+			changes=[f"{key} is {layout[key]}, expected {value}" for key, value in expected.items() if layout[key] != value]
+			if changes:
+				logger.warning(f"Vector table layout doesn't match .yaml file ({'; '.join(changes)}). Rebuilding it...")
+				incremental=False
+	if not incremental:
+		query="DROP TABLE IF EXISTS Vectors CASCADE; DROP TABLE IF EXISTS VectorFiles;"
+		if execute_non_query(connection, query)<-1:
+			return handle_logs(501,"Error while dropping vector table",logger.CRITICAL)
 
+	# chunk_tsv feeds the lexical side of hybrid search
+	tsv_column=f"chunk_tsv tsvector GENERATED ALWAYS AS (to_tsvector('{text_search_config(config)}'::regconfig, coalesce(chunk, ''))) STORED"
+	# The partition key must be part of the primary key. chunk_id already contains file_id, so uniqueness doesn't change
 	query=f"""
-		CREATE TABLE Vectors (
-			chunk_id    VARCHAR(100) PRIMARY KEY,
+		CREATE TABLE IF NOT EXISTS Vectors (
+			chunk_id    VARCHAR(100),
+			file_id     VARCHAR(16) NOT NULL,
 			filename    TEXT,
 			chunk       TEXT,
-			embedding   vector({config.llm_embedding_vector_len})
+			embedding   vector({config.llm_embedding_vector_len}),
+			{tsv_column},
+			PRIMARY KEY (chunk_id, file_id)
+		){' PARTITION BY HASH (file_id)' if partitions else ''};
+	"""
+	for remainder in range(partitions):
+		query+=f"CREATE TABLE IF NOT EXISTS vectors_p{remainder} PARTITION OF Vectors FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder});\n"
+	query+=f"""
+		ALTER TABLE Vectors ADD COLUMN IF NOT EXISTS {tsv_column};
+		CREATE INDEX IF NOT EXISTS vectors_file_id_idx ON Vectors (file_id);
+		CREATE INDEX IF NOT EXISTS vectors_chunk_tsv_idx ON Vectors USING gin (chunk_tsv);
+		CREATE TABLE IF NOT EXISTS VectorFiles (
+			filename        TEXT PRIMARY KEY,
+			file_id         VARCHAR(16) NOT NULL,
+			batch           VARCHAR(64),
+			content_hash    CHAR(64) NOT NULL,
+			chunk_count     INTEGER NOT NULL,
+			updated_at      TIMESTAMPTZ NOT NULL DEFAULT now()
 		);
+		ALTER TABLE VectorFiles ADD COLUMN IF NOT EXISTS batch VARCHAR(64);
+		CREATE INDEX IF NOT EXISTS vectorfiles_batch_idx ON VectorFiles (batch);
 	"""
 	if execute_non_query(connection, query)<-1:
 		return handle_logs(503,"Error while creating vector table",logger.CRITICAL)
 
 	return handle_logs()
 
-def execute_non_query(connection, query):
+# Text search configuration of each supported language
+TEXT_SEARCH_CONFIGS={'en': 'english', 'fr': 'french'}
+
+def text_search_config(config):
+	"""
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		string: PostgreSQL text search configuration matching config.language
+	"""
+	return TEXT_SEARCH_CONFIGS.get(config.language, 'simple')
+
+def vector_table_layout(connection):
+	"""
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		dict: Embedding length ('dimension'), whether it has column file_id ('has_file_id') and number
+		of partitions ('partitions') of table Vectors. None if the table doesn't exist
+	"""
+	query = """
+	SELECT
+		(SELECT atttypmod FROM pg_attribute WHERE attrelid = T.oid AND attname = 'embedding' AND NOT attisdropped),
+		EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = T.oid AND attname = 'file_id' AND NOT attisdropped),
+		(SELECT COUNT(*) FROM pg_inherits WHERE inhparent = T.oid)
+	FROM (SELECT to_regclass('vectors') AS oid) T
+	WHERE T.oid IS NOT NULL;
+	"""
+	rows = fetch_rows(connection, query)
+	if not rows:
+		return None
+	dimension, has_file_id, partitions = rows[0]
+	return {'dimension': int(dimension), 'has_file_id': bool(has_file_id), 'partitions': int(partitions)}
+
+def vector_file_states(connection):
+	"""
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		dict: (file_id, content_hash) of each file loaded in table Vectors, keyed by filename. None if it couldn't be retrieved
+	"""
+	try:
+		return {filename: (file_id, content_hash) for filename, file_id, content_hash in stream_rows(connection, "SELECT filename, file_id, content_hash FROM VectorFiles;")}
+	except Exception:
+		return None
+
+def register_vector_file(connection, filename, file_id, content_hash, chunk_ids, batch=None):
+	"""
+	Records the content hash of a file whose chunks have just been loaded, and deletes its chunks that
+	weren't part of that load (the file got shorter). Both changes are committed together
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		string (filename): File path, as stored in table Vectors
+		string (file_id): File ID
+		string (content_hash): Hash of the file content and the chunking settings
+		list (chunk_ids): IDs of every chunk of the file
+		string (batch): Ingestion batch that loaded the file
+
+	Returns:
+		Message Code, and Message Text.
+	"""
+	query = """
+	DELETE FROM Vectors WHERE file_id = %s AND chunk_id <> ALL(%s);
+	INSERT INTO VectorFiles (filename, file_id, batch, content_hash, chunk_count)
+	VALUES (%s, %s, %s, %s, %s)
+	ON CONFLICT (filename) DO UPDATE SET
+		file_id=EXCLUDED.file_id, batch=EXCLUDED.batch, content_hash=EXCLUDED.content_hash,
+		chunk_count=EXCLUDED.chunk_count, updated_at=now();
+	"""
+	params=(file_id, list(chunk_ids), filename, file_id, batch, content_hash, len(chunk_ids))
+	if execute_non_query(connection, query, params)<-1:
+		return handle_logs(512,f"Error while registering file {filename} in vector table",logger.CRITICAL)
+	return handle_logs()
+
+def remove_vector_files(connection, filenames):
+	"""
+	Deletes every chunk of the given files
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		list (filenames): File paths, as stored in table Vectors
+
+	Returns:
+		Message Code, and Message Text.
+	"""
+	if not filenames:
+		return handle_logs()
+	query = """
+	DELETE FROM Vectors WHERE file_id = ANY(ARRAY(SELECT file_id FROM VectorFiles WHERE filename = ANY(%s)));
+	DELETE FROM VectorFiles WHERE filename = ANY(%s);
+	"""
+	if execute_non_query(connection, query, (list(filenames), list(filenames)))<-1:
+		return handle_logs(513,"Error while removing files from vector table",logger.CRITICAL)
+	logger.info(f"Removed {len(filenames)} file(s) that are no longer in the PDF folder from vector table")
+	return handle_logs()
+
+def execute_non_query(connection, query, params=None):
 	"""Execute a non-SELECT query (INSERT, UPDATE, DELETE, etc.)"""
-	cursor = connection.cursor()
 	row_count = -1
-	try:
-		cursor.execute(query)
-		connection.commit()
-		logger.debug("Query executed successfully. Committing changes...")
-		# Get number of affected rows
-		row_count = cursor.rowcount
-		logger.debug(f"Affected rows: {row_count}")
-	except Exception as e:
-		logger.error(f"The error '{e}' occurred. Rolling back...")
-		connection.rollback()
-		row_count = -2
-	finally:
-		cursor.close()
+	with connection_scope(connection) as connection:
+		cursor = connection.cursor()
+		try:
+			cursor.execute(query, params)
+			connection.commit()
+			logger.debug("Query executed successfully. Committing changes...")
+			# Get number of affected rows
+			row_count = cursor.rowcount
+			logger.debug(f"Affected rows: {row_count}")
+		except Exception as e:
+			logger.error(f"The error '{e}' occurred. Rolling back...")
+			connection.rollback()
+			row_count = -2
+		finally:
+			cursor.close()
 	return row_count
 
 def execute_sql_file(connection, sql_file):
 	"""Execute a non-SELECT query (INSERT, UPDATE, DELETE, etc.)"""
-	cursor = connection.cursor()
 	sql_successful=True
-	try:
-		cursor.execute(open(sql_file, "r").read())
-		connection.commit()
-		logger.debug("Query executed successfully. Committing changes...")
-	except Exception as e:
-		logger.error(f"The error '{e}' occurred. Rolling back...")
-		connection.rollback()
-		sql_successful=False
-	finally:
-		cursor.close()
+	with connection_scope(connection) as connection:
+		cursor = connection.cursor()
+		try:
+			cursor.execute(open(sql_file, "r").read())
+			connection.commit()
+			logger.debug("Query executed successfully. Committing changes...")
+		except Exception as e:
+			logger.error(f"The error '{e}' occurred. Rolling back...")
+			connection.rollback()
+			sql_successful=False
+		finally:
+			cursor.close()
 	return sql_successful
 
-def insert_chunks_with_vectors(connection, chunk):
-	new_text=escape_string_for_sql(chunk['text'], add_single_quotes=False)
-	query=f"""
-		INSERT INTO Vectors (
-			chunk_id, 				filename, 				chunk, 			embedding
-		) VALUES (
-			'{chunk['chunkId']}', 	'{chunk['filename']}', 	'{new_text}', '{chunk['embedding']}'
-		);
+# Hot statements, prepared once per pooled connection. Each one is declared with its parameter types
+# and its query using %s placeholders, which is also what runs on connections that can't prepare it.
+# {candidate_order} is the distance that picks nearest-chunk candidates through the ANN index (see
+# candidate_order_sql); candidates are then ranked by their exact distance to the question
+PREPARED_STATEMENTS={
+	'cosine_vector_search': (['vector', 'vector', 'integer', 'integer'], """
+		WITH candidates AS MATERIALIZED (
+			SELECT chunk_id, filename, chunk, embedding <=> %s::vector AS distance
+			FROM Vectors
+			ORDER BY {candidate_order}
+			LIMIT %s
+		)
+		SELECT chunk_id, filename, chunk FROM candidates
+		ORDER BY distance
+		FETCH FIRST %s ROW ONLY;
+	"""),
+	# Nearest chunks among the given file IDs (see vector_filter_file_ids). Partitions are only pruned when the
+	# array is a constant, so it must run with a custom plan. With an iterative index scan the candidates may
+	# come slightly out of order, which the final sort also fixes
+	'filtered_vector_search': (['vector', 'text[]', 'vector', 'integer', 'integer'], """
+		WITH candidates AS MATERIALIZED (
+			SELECT chunk_id, filename, chunk, embedding <=> %s::vector AS distance
+			FROM Vectors
+			WHERE file_id = ANY(%s::text[])
+			ORDER BY {candidate_order}
+			LIMIT %s
+		)
+		SELECT chunk_id, filename, chunk FROM candidates
+		ORDER BY distance
+		FETCH FIRST %s ROW ONLY;
+	"""),
+	# Nearest chunks of several questions at once: one lateral (index) search per question embedding.
+	# Embeddings arrive as text[], since that's how psycopg2 sends a list of vectors
+	'batch_vector_search': (['text[]', 'integer', 'integer'], """
+		SELECT Q.position, N.chunk_id, N.filename, N.chunk
+		FROM unnest(%s::text[]::vector[]) WITH ORDINALITY AS Q(embedding, position)
+		CROSS JOIN LATERAL (
+			SELECT chunk_id, filename, chunk, distance
+			FROM (
+				SELECT chunk_id, filename, chunk, embedding <=> Q.embedding AS distance
+				FROM Vectors
+				ORDER BY {lateral_candidate_order}
+				LIMIT %s
+			) C
+			ORDER BY distance
+			LIMIT %s
+		) N
+		ORDER BY Q.position, N.distance;
+	"""),
+	# Reciprocal rank fusion of the nearest chunks and the best full-text matches (any of the question terms)
+	'hybrid_vector_search': (['vector', 'vector', 'integer', 'integer', 'regconfig', 'text', 'integer', 'float8', 'float8', 'integer'], """
+		WITH semantic AS (
+			SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+			FROM (
+				SELECT chunk_id, distance
+				FROM (
+					SELECT chunk_id, embedding <=> %s::vector AS distance
+					FROM Vectors
+					ORDER BY {candidate_order}
+					LIMIT %s
+				) C
+				ORDER BY distance
+				LIMIT %s
+			) S
+		),
+		lexical AS (
+			SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+			FROM (
+				SELECT V.chunk_id, ts_rank_cd(V.chunk_tsv, Q.query) AS score
+				FROM Vectors V, CAST(replace(plainto_tsquery(%s::regconfig, %s)::text, '&', '|') AS tsquery) AS Q(query)
+				WHERE V.chunk_tsv @@ Q.query
+				ORDER BY score DESC
+				LIMIT %s
+			) L
+		)
+		SELECT V.chunk_id, V.filename, V.chunk
+		FROM (
+			SELECT 	COALESCE(S.chunk_id, L.chunk_id) AS chunk_id,
+					COALESCE(1.0/(%s + S.rank), 0) + COALESCE(1.0/(%s + L.rank), 0) AS score
+			FROM 	semantic S
+			FULL OUTER JOIN lexical L ON S.chunk_id = L.chunk_id
+		) F
+		INNER JOIN Vectors V ON V.chunk_id = F.chunk_id
+		ORDER BY F.score DESC
+		FETCH FIRST %s ROW ONLY;
+	"""),
+}
+
+def candidate_order_sql(config, question="%s::vector"):
 	"""
-	if execute_non_query(connection, query)<-1:
-		return handle_logs(504,"Error while inserting in vector table",logger.CRITICAL)
+	Distance used to pick nearest-chunk candidates. It must match the expression of the ANN index (see
+	vector_index_column_sql)
 
-	return handle_logs()
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		string (question): SQL expression of the question embedding. By default, a query parameter
 
-def cosine_vector_search(connection, config, vector):
-	query = f"""
-	SELECT chunk_id, filename, chunk FROM Vectors
-	ORDER BY embedding <=> '{vector}'
-	FETCH FIRST {config.k_most_similar} ROW ONLY;
+	Returns:
+		string: SQL expression
 	"""
-	df = execute_query(connection, query, ['chunk_id', 'filename', 'chunk'])
-	return df
+	storage=getattr(config, 'vector_storage', 'full')
+	dimension=config.llm_embedding_vector_len
+	if storage == 'halfvec':
+		return f"embedding::halfvec({dimension}) <=> {question}::halfvec({dimension})"
+	if storage == 'binary':
+		return f"binary_quantize(embedding)::bit({dimension}) <~> binary_quantize({question})"
+	return f"embedding <=> {question}"
+
+def candidate_pool(config, k):
+	"""
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		int (k): Number of chunks that will be kept
+
+	Returns:
+		int: Number of candidates fetched through the ANN index to keep the k nearest ones. With quantized
+		storage, more candidates than k are fetched and re-ranked by exact distance
+	"""
+	if getattr(config, 'vector_storage', 'full') == 'full':
+		return k
+	return max(k, getattr(config, 'rerank_candidates', 40))
+
+def prepared_statement(connection, name, config=None):
+	"""
+	Prepares a statement of PREPARED_STATEMENTS in a connection the first time it's used there
+
+	Params:
+		psycopg2.connection (connection): Database connnection. Only PooledConnection instances keep prepared statements
+		string (name): Statement name
+		dict (config): Configuration dictionary using values from .yaml file. Required by statements that search nearest chunks
+
+	Returns:
+		string (query): Statement to run with the same parameters: either EXECUTE of the prepared statement, or the plain query
+	"""
+	param_types, query = PREPARED_STATEMENTS[name]
+	if config is not None:
+		query=query.format(candidate_order=candidate_order_sql(config), lateral_candidate_order=candidate_order_sql(config, "Q.embedding"))
+	prepared=getattr(connection, 'prepared', None)
+	if prepared is None:
+		return query
+	if name not in prepared:
+		positions=iter(range(1, len(param_types)+1))
+		body=sub(r'%s', lambda match: f'${next(positions)}', query.strip().rstrip(';'))
+		if execute_non_query(connection, f"PREPARE {name} ({', '.join(param_types)}) AS {body};")<-1:
+			return query
+		prepared.add(name)
+	return f"EXECUTE {name} ({', '.join(['%s']*len(param_types))});"
+
+class VectorBulkLoader:
+	"""
+	Buffers text chunks and streams them into table Vectors with COPY FROM STDIN. Rows are committed
+	every batch_size chunks, or whenever flush is called. In upsert mode, chunks are copied into a staging
+	table and merged into Vectors by chunk_id, leaving unchanged chunks untouched
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+		bool (upsert): Whether chunks may already exist in table Vectors
+	"""
+	COLUMNS="chunk_id, file_id, filename, chunk, embedding"
+	STAGING_TABLE="vectors_staging"
+	# Binary COPY header: signature, flags and header extension length
+	BINARY_HEADER=b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+	BINARY_TRAILER=struct.pack('!h', -1)
+
+	def __init__(self, connection, config, upsert=False):
+		self.connection=connection
+		self.upsert=upsert
+		self.batch_size=getattr(config, 'vector_copy_batch_size', 1000)
+		self.binary=getattr(config, 'vector_copy_format', 'binary') == 'binary'
+		self.vector_len=config.llm_embedding_vector_len
+		with connection_scope(connection) as session:
+			self.encoding=encodings.get(session.encoding, 'utf-8')
+		self.rows=[]
+		self.loaded=0
+
+	def add(self, chunk):
+		"""
+		Adds a chunk to the buffer, flushing it once it reaches batch_size chunks
+
+		Params:
+			dict (chunk): Text chunk with metadata, including its embedding
+
+		Returns:
+			Message Code, and Message Text.
+		"""
+		if chunk['embedding'] is None:
+			return handle_logs(504,f"Chunk {chunk['chunkId']} doesn't have an embedding to insert in vector table",logger.CRITICAL)
+		embedding=np.asarray(chunk['embedding'], dtype='>f4')
+		if len(embedding) != self.vector_len:
+			return handle_logs(504,f"Chunk {chunk['chunkId']} has an embedding of length {len(embedding)}, expected {self.vector_len}",logger.CRITICAL)
+		self.rows.append((chunk['chunkId'], chunk['fileId'], chunk['filename'], clean_text_for_sql(chunk['text']), embedding))
+		if self.batch_size and len(self.rows) >= self.batch_size:
+			return self.flush()
+		return handle_logs()
+
+	def flush(self):
+		"""
+		Copies every buffered chunk into table Vectors and commits
 
-def llm_input_string(config, connection, df, table_name, general_id_var_name, general_id, df_var_field_name, df_llm_input_field_name, variables):
-	if len(df)==0:
-		query = f"""
-		SELECT DISTINCT lang
-		FROM {table_name}
-		WHERE {general_id_var_name}={general_id};
+		Returns:
+			Message Code, and Message Text.
 		"""
-		df = execute_query(connection, query, ['lang'])
-		if df is None:
-			logger.error('Failed at retrieving data from database when searching for valid languages.')
-		elif len(df)==0:
-			logger.error(f"{general_id_var_name} {general_id} does not have registered prompts on any language")
+		if not self.rows:
+			return handle_logs()
+		rows=self.rows
+		self.rows=[]
+		table=self.STAGING_TABLE if self.upsert else "Vectors"
+		if self.binary:
+			query=f"COPY {table} ({self.COLUMNS}) FROM STDIN WITH (FORMAT binary);"
+			data=self.binary_copy_data(rows)
 		else:
-			logger.error(f"There aren't prompts of required operation in language {config.language}. However, the following can be used {df['lang'].tolist()}")
-		return ''
+			query=f"COPY {table} ({self.COLUMNS}) FROM STDIN;"
+			data=self.text_copy_data(rows)
+		with connection_scope(self.connection) as connection:
+			cursor = connection.cursor()
+			try:
+				if self.upsert:
+					cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.STAGING_TABLE} (LIKE Vectors) ON COMMIT DELETE ROWS;")
+				cursor.copy_expert(query, data)
+				if self.upsert:
+					cursor.execute(f"""
+						INSERT INTO Vectors ({self.COLUMNS})
+						SELECT {self.COLUMNS} FROM {self.STAGING_TABLE}
+						ON CONFLICT (chunk_id, file_id) DO UPDATE SET
+							filename=EXCLUDED.filename, chunk=EXCLUDED.chunk, embedding=EXCLUDED.embedding
+						WHERE (Vectors.filename, Vectors.chunk, Vectors.embedding) IS DISTINCT FROM (EXCLUDED.filename, EXCLUDED.chunk, EXCLUDED.embedding);
+					""")
+				connection.commit()
+			except Exception as e:
+				logger.error(f"The error '{e}' occurred. Rolling back...")
+				connection.rollback()
+				return handle_logs(508,f"Error while copying {len(rows)} chunks into vector table",logger.CRITICAL)
+			finally:
+				cursor.close()
+		self.loaded+=len(rows)
+		logger.debug(f"Copied {len(rows)} chunks into vector table ({self.loaded} in total)")
+		return handle_logs()
 
-	prompt=""
-	df.fillna('',inplace=True)
-	for i in range(len(df)):
-		subprompt_variables = {}
-		skip_prompt=False
-		if df.iloc[i][df_var_field_name]:
-			sql_variables=df.iloc[i][df_var_field_name].split(',')
-			for sql_variable in sql_variables:
-				if sql_variable.strip() not in variables.keys():
-					logger.warning(f'Missing variable {sql_variable.strip()}. Skipping prompt...')
-					skip_prompt=True
-				else:
-					subprompt_variables[ sql_variable.strip() ]=variables[ sql_variable.strip() ]
-		if not skip_prompt:
-			partial_prompt=df.iloc[i][df_llm_input_field_name]
-			if subprompt_variables:
-				partial_prompt=partial_prompt.format_map(subprompt_variables)
-			prompt+=partial_prompt+'\n'
-	return prompt
+	def binary_copy_data(self, rows):
+		"""
+		Params:
+			list (rows): Tuples of chunk_id, file_id, filename, chunk and big-endian float32 embedding
 
-def select_prompt(connection, config, general_prompt_id, variables={}):
-	query = f"""
-	SELECT prompt_id, sequence_id, prompt, variables
-	FROM Prompts
-	WHERE general_prompt_id={general_prompt_id} AND lang='{config.language}'
-	ORDER BY sequence_id;
+		Returns:
+			io.BytesIO: Rows in COPY binary format
+		"""
+		data=BytesIO()
+		data.write(self.BINARY_HEADER)
+		for chunk_id, file_id, filename, chunk, embedding in rows:
+			data.write(struct.pack('!h', 5))
+			for value in (chunk_id, file_id, filename, chunk):
+				encoded=value.encode(self.encoding)
+				data.write(struct.pack('!i', len(encoded)))
+				data.write(encoded)
+			# pgvector binary format: dimensions, unused, float32 values
+			data.write(struct.pack('!ihh', 4 + 4*len(embedding), len(embedding), 0))
+			data.write(embedding.tobytes())
+		data.write(self.BINARY_TRAILER)
+		data.seek(0)
+		return data
+
+	def text_copy_data(self, rows):
+		"""
+		Params:
+			list (rows): Tuples of chunk_id, file_id, filename, chunk and big-endian float32 embedding
+
+		Returns:
+			io.BytesIO: Rows in COPY text format
+		"""
+		data=BytesIO()
+		for chunk_id, file_id, filename, chunk, embedding in rows:
+			fields=[self.escape_copy_text(value) for value in (chunk_id, file_id, filename, chunk)]
+			fields.append('[' + ','.join(repr(float(value)) for value in embedding) + ']')
+			data.write(('\t'.join(fields) + '\n').encode(self.encoding))
+		data.seek(0)
+		return data
+
+	@staticmethod
+	def escape_copy_text(value):
+		return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+	def close(self):
+		"""
+		Flushes the remaining chunks
+
+		Returns:
+			Message Code, and Message Text.
+		"""
+		return self.flush()
+
+VECTOR_INDEX_NAME="vectors_embedding_idx"
+
+def ivfflat_lists(connection, config):
+	"""
+	Number of IVFFlat lists. If vector_ivfflat_lists is 0, it's derived from the number of rows:
+	rows/1000 up to 1M rows, and sqrt(rows) beyond
+
+	Params:
+		psycopg2.connection (connection): Database connnection
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		int: Number of lists
+	"""
+	lists=getattr(config, 'vector_ivfflat_lists', 0)
+	if lists:
+		return lists
+	result = fetch_rows(connection, "SELECT COUNT(*) FROM Vectors;")
+	rows = 0 if not result else int(result[0][0])
+	if rows <= 1000000:
+		return max(1, rows // 1000)
+	return int(rows ** 0.5)
+
+def vector_index_column_sql(config):
+	"""
+	Indexed expression and operator class of the ANN index. With quantized storage the index holds half-precision
+	or binary vectors (2x or 32x smaller), while the table keeps full-precision vectors to re-rank candidates
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		string: SQL index column
+	"""
+	storage=getattr(config, 'vector_storage', 'full')
+	dimension=config.llm_embedding_vector_len
+	if storage == 'halfvec':
+		return f"(embedding::halfvec({dimension})) halfvec_cosine_ops"
+	if storage == 'binary':
+		return f"(binary_quantize(embedding)::bit({dimension})) bit_hamming_ops"
+	return "embedding vector_cosine_ops"
+
+def create_vector_index(connection, config):
+	"""
+	(Re)builds the ANN index of table Vectors declared in .yaml file. It should run after bulk loads,
+	since both index types build faster at once than row by row, and IVFFlat lists are trained on existing rows.
+	Error Interval: [509,510]
+
+	Params:
+		psycopg2.connection (connection): Database connnection
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		Message Code, and Message Text.
 	"""
-	df = execute_query(connection, query, ['prompt_id', 'sequence_id', 'prompt', 'variables'])
+	# SET maintenance_work_mem only applies to the session that builds the index
+	with connection_scope(connection) as connection:
+		index_type=getattr(config, 'vector_index_type', 'none')
+		query=f"DROP INDEX IF EXISTS {VECTOR_INDEX_NAME};"
+		if execute_non_query(connection, query)<-1:
+			return handle_logs(509,"Error while dropping vector index",logger.CRITICAL)
+		if index_type == 'none':
+			logger.info("No vector index declared. Vector search will scan the whole table")
+			return handle_logs()
+		if index_type == 'hnsw':
+			options=f"m = {int(getattr(config, 'vector_hnsw_m', 16))}, ef_construction = {int(getattr(config, 'vector_hnsw_ef_construction', 64))}"
+		else:
+			options=f"lists = {int(ivfflat_lists(connection, config))}"
+		work_mem=getattr(config, 'vector_index_work_mem', None)
+		if work_mem:
+			execute_non_query(connection, "SET maintenance_work_mem = %s;", (work_mem,))
+		logger.info(f"Building {index_type} vector index with {options}. This may take a while...")
+		query=f"""
+			CREATE INDEX {VECTOR_INDEX_NAME} ON Vectors
+			USING {index_type} ({vector_index_column_sql(config)})
+			WITH ({options});
+		"""
+		index_created=execute_non_query(connection, query)>=-1
+		if work_mem:
+			execute_non_query(connection, "RESET maintenance_work_mem;")
+		if not index_created:
+			return handle_logs(510,f"Error while creating {index_type} vector index",logger.CRITICAL)
+		execute_non_query(connection, "ANALYZE Vectors;")
+		return handle_logs()
+
+def ensure_vector_index(connection, config):
+	"""
+	Builds the ANN index declared in .yaml file only if table Vectors doesn't already have it. Both index
+	types stay valid through inserts, updates and deletes, so incremental builds don't rebuild them
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		Message Code, and Message Text.
+	"""
+	index_type=getattr(config, 'vector_index_type', 'none')
+	df=vector_index_info(connection)
+	if df is not None:
+		definitions=df.loc[df['index']==VECTOR_INDEX_NAME, 'definition'].tolist()
+		operator_class=vector_index_column_sql(config).split()[-1]
+		if (index_type == 'none' and not definitions) or any(f"USING {index_type} " in definition and operator_class in definition for definition in definitions):
+			if index_type == 'ivfflat':
+				logger.info("IVFFlat lists were trained on the rows present when the index was built. Use --vector-index rebuild after large changes")
+			execute_non_query(connection, "ANALYZE Vectors;")
+			return handle_logs()
+	return create_vector_index(connection, config)
+
+def vector_index_info(connection):
+	"""
+	Describes the indexes of table Vectors
+
+	Params:
+		psycopg2.connection (connection): Database connnection
+
+	Returns:
+		pandas.DataFrame: Name, definition, size and number of scans of each index. None if it couldn't be retrieved
+	"""
+	# Indexes of a partitioned table are summed over its partitions
+	query = """
+	SELECT 		I.indexname, I.indexdef,
+				pg_size_pretty((SELECT SUM(pg_relation_size(T.relid)) FROM pg_partition_tree(format('%I.%I', I.schemaname, I.indexname)::regclass) T)) AS size,
+				(SELECT SUM(S.idx_scan) FROM pg_partition_tree(format('%I.%I', I.schemaname, I.indexname)::regclass) T
+				 INNER JOIN pg_stat_user_indexes S ON S.indexrelid=T.relid) AS scans
+	FROM 		pg_indexes I
+	WHERE 		I.tablename='vectors'
+	ORDER BY 	I.indexname;
+	"""
+	return execute_query(connection, query, ['index', 'definition', 'size', 'scans'])
+
+def cosine_vector_search(connection, config, vector, filters=None):
+	"""
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+		numpy.ndarray (vector): Question embedding
+		dict (filters): Optional lists of 'filenames' (full paths or file names), 'file_ids' and 'batches' the chunks must belong to
+
+	Returns:
+		pandas.DataFrame: Nearest config.k_most_similar chunks. None if the query failed
+	"""
+	candidates=candidate_pool(config, config.k_most_similar)
+	with connection_scope(connection) as connection:
+		if not filters:
+			params=(vector, vector, candidates, config.k_most_similar)
+			df = execute_query(connection, prepared_statement(connection, 'cosine_vector_search', config), ['chunk_id', 'filename', 'chunk'], params)
+		else:
+			file_ids=vector_filter_file_ids(connection, filters)
+			if file_ids is None:
+				return None
+			if not file_ids:
+				logger.warning(f"No loaded file matches the vector search filters {filters}")
+				return pd.DataFrame(columns=['chunk_id', 'filename', 'chunk'])
+			params=(vector, file_ids, vector, candidates, config.k_most_similar)
+			# A generic plan would scan every partition. SET LOCAL only lasts until the end of the transaction
+			query="SET LOCAL plan_cache_mode = force_custom_plan; " + prepared_statement(connection, 'filtered_vector_search', config)
+			df = execute_query(connection, query, ['chunk_id', 'filename', 'chunk'], params)
+	return df
+
+def vector_filter_file_ids(connection, filters):
+	"""
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (filters): Optional lists of 'filenames' (full paths or file names), 'file_ids' and 'batches' the chunks must belong to
+
+	Returns:
+		list (file_ids): IDs of the loaded files that match every given filter. None if the query failed
+	"""
+	filenames, file_ids, batches = [filters.get(key) or None for key in ['filenames', 'file_ids', 'batches']]
+	query = """
+	SELECT 	file_id FROM VectorFiles
+	WHERE 	(%s::text[] IS NULL OR filename = ANY(%s::text[]) OR regexp_replace(filename, '^.*/', '') = ANY(%s::text[]))
+	AND 	(%s::text[] IS NULL OR file_id = ANY(%s::text[]))
+	AND 	(%s::text[] IS NULL OR batch = ANY(%s::text[]));
+	"""
+	rows = fetch_rows(connection, query, params=(filenames, filenames, filenames, file_ids, file_ids, batches, batches))
+	if rows is None:
+		return None
+	return [file_id for file_id, in rows]
+
+def batch_cosine_vector_search(connection, config, vectors):
+	"""
+	Searches the nearest chunks of several question embeddings in a single statement
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+		list (vectors): Question embeddings
+
+	Returns:
+		list: Nearest config.k_most_similar chunks (pandas.DataFrame) of each embedding, in the same order. None if the query failed
+	"""
+	if not vectors:
+		return []
+	params=(list(vectors), candidate_pool(config, config.k_most_similar), config.k_most_similar)
+	with connection_scope(connection) as connection:
+		df = execute_query(connection, prepared_statement(connection, 'batch_vector_search', config), ['position', 'chunk_id', 'filename', 'chunk'], params)
 	if df is None:
+		return None
+	columns=['chunk_id', 'filename', 'chunk']
+	groups={position: group[columns].reset_index(drop=True) for position, group in df.groupby('position')}
+	return [groups.get(position, pd.DataFrame(columns=columns)) for position in range(1, len(vectors)+1)]
+
+def hybrid_vector_search(connection, config, vector, question):
+	"""
+	Ranks chunks by embedding distance and by full-text match in one statement, then fuses both rankings
+	with reciprocal rank fusion: score = 1/(hybrid_rrf_k + vector rank) + 1/(hybrid_rrf_k + text rank)
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+		dict (config): Configuration dictionary using values from .yaml file
+		numpy.ndarray (vector): Question embedding
+		string (question): Question text
+
+	Returns:
+		pandas.DataFrame: Best config.k_most_similar chunks. None if the query failed
+	"""
+	candidates=max(getattr(config, 'hybrid_candidates', 50), config.k_most_similar)
+	rrf_k=getattr(config, 'hybrid_rrf_k', 60)
+	params=(vector, vector, candidate_pool(config, candidates), candidates, text_search_config(config), question, candidates, rrf_k, rrf_k, config.k_most_similar)
+	with connection_scope(connection) as connection:
+		df = execute_query(connection, prepared_statement(connection, 'hybrid_vector_search', config), ['chunk_id', 'filename', 'chunk'], params)
+	return df
+
+TemplatePart=namedtuple('TemplatePart', ['text', 'variables'])
+
+class PromptStore:
+	"""
+	Tables Prompts and Examples compiled in memory, so prompts are rendered without querying the database.
+	Templates are keyed by (general_prompt_id, lang), with their variable lists already parsed
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+	"""
+	def __init__(self, connection):
+		self.prompts={}
+		self.prompt_langs={}
+		self.prompts_with_examples=set()
+		self.examples={}
+		query = """
+		SELECT general_prompt_id, lang, prompt, variables
+		FROM Prompts
+		ORDER BY sequence_id;
+		"""
+		rows = fetch_rows(connection, query)
+		if rows is None:
+			raise ValueError('Failed at retrieving data from database when loading prompts.')
+		for general_prompt_id, lang, prompt, variables in rows:
+			prompt, variables = prompt or '', variables or ''
+			self.prompts.setdefault((general_prompt_id, lang), []).append(self.compile(prompt, variables))
+			self.prompt_langs.setdefault(general_prompt_id, set()).add(lang)
+			if variables == 'examples':
+				self.prompts_with_examples.add((general_prompt_id, lang))
+		query = """
+		SELECT 		P.general_prompt_id AS general_prompt_id, E.lang AS lang,
+					E.general_example_id AS general_example_id,
+					E.example AS example, E.variables AS variables
+		FROM 		Examples E
+		INNER JOIN 	Prompts P ON E.prompt_id=P.prompt_id
+		ORDER BY E.sequence_id;
+		"""
+		rows = fetch_rows(connection, query)
+		if rows is None:
+			raise ValueError('Failed at retrieving data from database when loading examples.')
+		for general_prompt_id, lang, general_example_id, example, variables in rows:
+			example, variables = example or '', variables or ''
+			general_example_ids, parts = self.examples.setdefault((general_prompt_id, lang), ([], []))
+			if general_example_id not in general_example_ids:
+				general_example_ids.append(general_example_id)
+			parts.append(self.compile(example, variables))
+
+	@staticmethod
+	def compile(text, variables):
+		"""
+		Params:
+			string (text): Template
+			string (variables): Comma-separated names of the variables used by the template
+
+		Returns:
+			TemplatePart: Template with its list of variables
+		"""
+		return TemplatePart(text, tuple(variable.strip() for variable in variables.split(',')) if variables else ())
+
+	@staticmethod
+	def render(parts, variables):
+		"""
+		Params:
+			list (parts): Compiled templates, in order
+			dict (variables): Values of the template variables. Templates using a missing variable are skipped
+
+		Returns:
+			string: Rendered templates, one per line
+		"""
+		prompt=""
+		for part in parts:
+			missing=[variable for variable in part.variables if variable not in variables]
+			for variable in missing:
+				logger.warning(f'Missing variable {variable}. Skipping prompt...')
+			if missing:
+				continue
+			partial_prompt=part.text
+			if part.variables:
+				partial_prompt=partial_prompt.format_map({variable: variables[variable] for variable in part.variables})
+			prompt+=partial_prompt+'\n'
+		return prompt
+
+
+_prompt_store=None
+_prompt_store_lock=threading.Lock()
+
+def get_prompt_store(connection):
+	"""
+	Returns the prompt store of this process, loading it the first time it's needed
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		PromptStore (store): Prompt store, or None if the tables couldn't be read
+	"""
+	global _prompt_store
+	with _prompt_store_lock:
+		if _prompt_store is None:
+			try:
+				_prompt_store=PromptStore(connection)
+				logger.debug(f"Prompt store loaded: {len(_prompt_store.prompts)} prompts, {len(_prompt_store.examples)} example sets")
+			except ValueError as ve:
+				logger.error(str(ve))
+		return _prompt_store
+
+def reload_prompt_store(connection):
+	"""
+	Discards the prompt store and loads it again. It must be called whenever tables Prompts or Examples change
+
+	Params:
+		psycopg2.connection|ConnectionPool (connection): Database connnection or pool
+
+	Returns:
+		PromptStore (store): Prompt store, or None if the tables couldn't be read
+	"""
+	global _prompt_store
+	with _prompt_store_lock:
+		_prompt_store=None
+	return get_prompt_store(connection)
+
+def select_prompt(connection, config, general_prompt_id, variables={}):
+	store=get_prompt_store(connection)
+	if store is None:
 		logger.error('Failed at retrieving data from database when searching for related prompts .')
 		return ''
-	if 'examples' in df['variables'].unique().tolist() and 'examples' not in variables:
+	parts=store.prompts.get((general_prompt_id, config.language))
+	if not parts:
+		langs=store.prompt_langs.get(general_prompt_id)
+		if not langs:
+			logger.error(f"general_prompt_id {general_prompt_id} does not have registered prompts on any language")
+		else:
+			logger.error(f"There aren't prompts of required operation in language {config.language}. However, the following can be used {sorted(langs)}")
+		return ''
+	if (general_prompt_id, config.language) in store.prompts_with_examples and 'examples' not in variables:
 		variables['examples']=select_example(connection, config, general_prompt_id, variables )
-	prompt=llm_input_string(config, connection, df, 'Prompts', 'general_prompt_id', general_prompt_id, 'variables', 'prompt', variables)
-	return prompt
+	return store.render(parts, variables)
 
 def select_example(connection, config, general_prompt_id, variables={} ):
-	query=f"""
-	SELECT 		P.prompt_id AS prompt_id, E.example_id AS example_id, 
-				E.general_example_id AS general_example_id,
-				E.sequence_id AS sequence_id, E.example AS example,
-				E.variables AS variables
-	FROM 		Examples E
-	INNER JOIN 	Prompts P ON E.prompt_id=P.prompt_id
-	WHERE P.general_prompt_id={general_prompt_id} AND E.lang='{config.language}'
-	ORDER BY E.sequence_id;
-	"""
-	df = execute_query(connection, query, ['prompt_id', 'example_id', 'general_example_id', 'sequence_id', 'example', 'variables'])
-	if df is None:
+	store=get_prompt_store(connection)
+	if store is None:
 		logger.error('Failed at retrieving data from database when searching for related examples .')
 		return ''
-	
+	general_example_ids, parts = store.examples.get((general_prompt_id, config.language), ([], []))
+
 	prompt=""
-	for general_id in df['general_example_id'].unique().tolist():
-		example_text=llm_input_string(config, connection, df, 'Examples', 'general_example_id', general_id, 'variables', 'example', variables)
+	for general_id in general_example_ids:
+		example_text=store.render(parts, variables)
 		if example_text:
 			if not prompt:
 				prompt='['
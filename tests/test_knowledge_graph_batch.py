@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memgraph_interface import KnowledgeGraphBatch
+
+
+class QueryGraph:
+	"""
+	Graph without a Bolt driver, which records the statements it runs
+	"""
+	def __init__(self):
+		self.queries=[]
+
+	def query(self, query, params={}):
+		self.queries.append((query, params))
+		return []
+
+def triple(head, head_type, tail='', tail_type='', relation='', prefix_id='F0C0'):
+	return {'head': head, 'head_type': head_type, 'relation': relation, 'tail': tail, 'tail_type': tail_type, 'prefix_id': prefix_id}
+
+def statement_index(statements, text, name):
+	"""
+	Returns the position of the first statement containing text, whose rows mention name
+	"""
+	for index, (query, params) in enumerate(statements):
+		if text in query and any(name in row.values() for row in params['rows']):
+			return index
+	raise AssertionError(f"No statement with {text} for {name}")
+
+def test_node_merges_keep_triple_order():
+	# Crack is a subclass of Damage, so (X, Crack) gets the Damage label, and the later (X, Damage) must match it
+	batch=KnowledgeGraphBatch(QueryGraph(), object(), [], [], {'Damage': 'http://x#Damage', 'Crack': 'http://x#Crack'}, {'http://x#Crack': ['http://x#Damage']}, {})
+	for conn in [triple('Y', 'Damage'), triple('X', 'Crack'), triple('X', 'Damage')]:
+		batch.add(conn)
+	statements=batch.statements()
+	crack=statement_index(statements, 'MERGE (m:Crack', 'X')
+	assert 'SET m:Damage' in statements[crack][0]
+	assert statement_index(statements, 'MERGE (m:Damage', 'Y') < crack < statement_index(statements, 'MERGE (m:Damage', 'X')
+	# Rows of different names still share a statement
+	assert len(statements) == 3
+
+def test_relations_match_nodes_of_their_triple():
+	batch=KnowledgeGraphBatch(QueryGraph(), None, [], [], {}, {}, {})
+	batch.add(triple('X', 'Damage', 'Z', 'Part', 'affects'))
+	batch.add(triple('X', 'Crack'))
+	statements=batch.statements()
+	assert statement_index(statements, 'MERGE (m)-[r:affects]->(n)', 'X') < statement_index(statements, 'MERGE (m:Crack', 'X')
+
+def test_flush_without_driver_runs_each_statement():
+	graph=QueryGraph()
+	batch=KnowledgeGraphBatch(graph, None, [], [], {}, {}, {})
+	batch.add(triple('X', 'Damage', 'Z', 'Part', 'affects'))
+	statements=batch.statements()
+	batch.flush()
+	assert graph.queries == statements
+	assert len(batch) == 0
+	batch.flush()
+	assert graph.queries == statements
@@ -0,0 +1,67 @@
+import os
+import re
+import sys
+from argparse import Namespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postgresql import PREPARED_STATEMENTS, candidate_order_sql
+
+
+STORAGE_MODES=['full', 'halfvec', 'binary']
+
+def prepare_sql(name, config):
+	"""
+	Builds the PREPARE statement prepared_statement sends for a statement of PREPARED_STATEMENTS
+
+	Params:
+		string (name): Statement name
+		dict (config): Configuration dictionary
+
+	Returns:
+		string: PREPARE statement
+	"""
+	param_types, query = PREPARED_STATEMENTS[name]
+	query=query.format(candidate_order=candidate_order_sql(config), lateral_candidate_order=candidate_order_sql(config, "Q.embedding"))
+	positions=iter(range(1, len(param_types)+1))
+	query=re.sub(r'%s', lambda match: f"${next(positions)}", query)
+	assert next(positions, None) is None, f"{name} has fewer placeholders than parameter types"
+	return f"PREPARE {name} ({', '.join(param_types)}) AS {query}"
+
+@pytest.mark.parametrize('storage', STORAGE_MODES)
+@pytest.mark.parametrize('name', sorted(PREPARED_STATEMENTS))
+def test_prepared_statement_parses(name, storage):
+	pglast=pytest.importorskip('pglast')
+	sql=prepare_sql(name, Namespace(vector_storage=storage, llm_embedding_vector_len=8))
+	assert sql.count('$') == len(PREPARED_STATEMENTS[name][0])
+	pglast.parse_sql(sql)
+
+@pytest.mark.parametrize('storage', STORAGE_MODES)
+def test_prepared_statements_prepare(storage):
+	"""
+	Prepares every statement in a real database with the pgvector extension, given by PGVECTOR_TEST_DSN.
+	Everything runs in a transaction that is rolled back
+	"""
+	dsn=os.environ.get('PGVECTOR_TEST_DSN')
+	if not dsn:
+		pytest.skip("PGVECTOR_TEST_DSN is not set")
+	import psycopg2
+	config=Namespace(vector_storage=storage, llm_embedding_vector_len=8, language='en')
+	connection=psycopg2.connect(dsn)
+	try:
+		cursor=connection.cursor()
+		cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+		cursor.execute("""
+			CREATE TEMP TABLE Vectors (
+				chunk_id VARCHAR(100), file_id VARCHAR(16) NOT NULL, filename TEXT, chunk TEXT,
+				embedding vector(8), chunk_tsv tsvector, PRIMARY KEY (chunk_id, file_id)
+			);
+			CREATE TEMP TABLE VectorFiles (filename TEXT PRIMARY KEY, file_id VARCHAR(16), batch VARCHAR(64));
+		""")
+		for name in PREPARED_STATEMENTS:
+			cursor.execute(prepare_sql(name, config))
+	finally:
+		connection.rollback()
+		connection.close()
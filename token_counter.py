@@ -0,0 +1,129 @@
+import threading
+from functools import lru_cache
+from pathlib import Path
+from base_logger import logger
+
+try:
+	from tokenizers import Tokenizer
+except ImportError:
+	Tokenizer = None
+
+
+class TokenCounter:
+	"""
+	Counts the tokens of a text. If config.llm_tokenizer_path points to a local tokenizer file (tokenizer.json) matching
+	the chat model, the count is exact; otherwise the llm_tokens_per_100_characters heuristic is used.
+	Counts are cached per string
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+	"""
+	def __init__(self, config):
+		self.tokens_per_100_characters=config.llm_tokens_per_100_characters
+		self.safety_margin=getattr(config, 'llm_token_safety_margin', 8)
+		self.tokenizer=load_tokenizer(getattr(config, 'llm_tokenizer_path', None))
+		self.count=lru_cache(maxsize=getattr(config, 'llm_token_cache_size', 65536))(self._count)
+
+	@property
+	def exact(self):
+		return self.tokenizer is not None
+
+	def _count(self, text):
+		if self.tokenizer is not None:
+			return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+		return int(len(text) * self.tokens_per_100_characters / 100)
+
+	def margin(self, heuristic_margin):
+		"""
+		Params:
+			int (heuristic_margin): Tokens reserved when counts are approximations
+
+		Returns:
+			int: Tokens to reserve on top of counted tokens
+		"""
+		if self.exact:
+			return self.safety_margin
+		return heuristic_margin
+
+
+def load_tokenizer(path):
+	"""
+	Loads a local tokenizer file
+
+	Params:
+		string (path): tokenizer.json file, or folder that contains it
+
+	Returns:
+		tokenizers.Tokenizer (tokenizer): Tokenizer, or None if it couldn't be loaded
+	"""
+	if not path:
+		return None
+	if Tokenizer is None:
+		logger.warning("Package 'tokenizers' is not installed. Falling back to llm_tokens_per_100_characters to count tokens")
+		return None
+	tokenizer_path=Path(path)
+	if tokenizer_path.is_dir():
+		tokenizer_path=tokenizer_path / "tokenizer.json"
+	try:
+		tokenizer=Tokenizer.from_file(str(tokenizer_path))
+		logger.info(f"Counting tokens with tokenizer {tokenizer_path}")
+		return tokenizer
+	except Exception as ex:
+		logger.warning(f"Tokenizer {tokenizer_path} couldn't be loaded ({ex}). Falling back to llm_tokens_per_100_characters to count tokens")
+		return None
+
+_token_counter=None
+_token_counter_lock=threading.Lock()
+
+def get_token_counter(config):
+	"""
+	Returns the token counter of this process, building it from config the first time it's needed
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		TokenCounter (counter): Token counter
+	"""
+	global _token_counter
+	with _token_counter_lock:
+		if _token_counter is None:
+			_token_counter=TokenCounter(config)
+		return _token_counter
+
+def count_tokens(config, text):
+	"""
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		string (text): Text
+
+	Returns:
+		int: Number of tokens of text
+	"""
+	return get_token_counter(config).count(text)
+
+def token_margin(config, heuristic_margin):
+	"""
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+		int (heuristic_margin): Tokens reserved when counts are approximations
+
+	Returns:
+		int: Tokens to reserve on top of counted tokens
+	"""
+	return get_token_counter(config).margin(heuristic_margin)
+
+def chunk_length_function(config):
+	"""
+	Length function used by text splitters. Chunk sizes are measured in tokens when an exact tokenizer is available, or in characters otherwise
+
+	Params:
+		dict (config): Configuration dictionary using values from .yaml file
+
+	Returns:
+		function: Length function
+	"""
+	token_counter=get_token_counter(config)
+	if token_counter.exact:
+		return token_counter.count
+	return len